@@ -23,6 +23,7 @@ import logging
 import argparse
 import importlib
 import signal
+import atexit
 
 from modules.shutdown import shutdown
 from modules.timekeeper import timekeeper
@@ -38,6 +39,8 @@ from modules.path import path
 from modules.server import WebServer
 from modules.events import Events
 from modules.history import ImageHistory
+from modules.processor import ImageProcessor
+from modules.statestore import StateStore
 
 # Make sure we run from our own directory
 os.chdir(os.path.dirname(sys.argv[0]))
@@ -47,6 +50,7 @@ parser.add_argument('--logfile', default=None, help="Log to file instead of stdo
 parser.add_argument('--port', default=7777, type=int, help="Port to listen on")
 parser.add_argument('--countdown', default=10, type=int, help="Set seconds to countdown before starting slideshow")
 parser.add_argument('--listen', default="0.0.0.0", help="Address to listen on")
+parser.add_argument('--workers', default=WebServer.WORKERS, type=int, help="Number of threads serving web requests")
 parser.add_argument('--debug', action='store_true', default=False, help='Enable loads more logging')
 parser.add_argument('--basedir', default=None, help='Change the root folder of photoframe')
 parser.add_argument('--emulate', action='store_true', help='Run as an app without root access or framebuffer')
@@ -77,15 +81,19 @@ class Photoframe:
     self.cacheMgr = CacheManager()
     self.settingsMgr = settings()
     self.displayMgr = display(self.emulator)
+    # Show what we had before as early as possible, configuring takes a while
+    self.displayMgr.restoreBootFrame()
     # Validate all settings, prepopulate with defaults if needed
     self.validateSettings()
 
     self.imageHistory = ImageHistory(self.settingsMgr)
+    self.processor = ImageProcessor()
     self.driverMgr = drivers()
     self.serviceMgr = ServiceManager(self.settingsMgr, self.cacheMgr)
 
     self.colormatch = colormatch(self.settingsMgr.get('colortemp-script'), 2700) # 2700K = Soft white, lowest we'll go
-    self.slideshow = slideshow(self.displayMgr, self.settingsMgr, self.colormatch, self.imageHistory)
+    self.displayMgr.setColormatch(self.colormatch)
+    self.slideshow = slideshow(self.displayMgr, self.settingsMgr, self.colormatch, self.imageHistory, self.processor)
     self.timekeeperMgr = timekeeper()
     self.timekeeperMgr.registerListener(self.displayMgr.enable)
     self.powerMgr = shutdown(self.settingsMgr.getUser('shutdown-pin'))
@@ -97,20 +105,33 @@ class Photoframe:
     self.timekeeperMgr.setConfiguration(self.settingsMgr.getUser('display-on'), self.settingsMgr.getUser('display-off'))
     self.timekeeperMgr.setAmbientSensitivity(self.settingsMgr.getUser('autooff-lux'), self.settingsMgr.getUser('autooff-time'))
     self.timekeeperMgr.setPowermode(self.settingsMgr.getUser('powersave'))
-    self.colormatch.setUpdateListener(self.timekeeperMgr.sensorListener)
+    self.colormatch.registerUpdateListener(self.timekeeperMgr.sensorListener)
+    self.colormatch.registerUpdateListener(self.displayMgr.colorListener)
 
     self.timekeeperMgr.registerListener(self.slideshow.shouldShow)
     self.slideshow.setServiceManager(self.serviceMgr)
     self.slideshow.setCacheManager(self.cacheMgr)
+    self.slideshow.setEventManager(self.eventMgr)
+    self.serviceMgr.setEventManager(self.eventMgr)
+    self.colormatch.setEventManager(self.eventMgr)
     self.slideshow.setCountdown(cmdline.countdown)
 
     # Prep the webserver
-    self.setupWebserver(cmdline.listen, cmdline.port)
+    self.setupWebserver(cmdline.listen, cmdline.port, cmdline.workers)
 
     # Force display to desired user setting
     self.displayMgr.enable(True, True)
 
+  def terminate(self, x, y):
+    # systemd stops (and reboots) us with SIGTERM, which skips atexit
+    logging.info('Terminating, saving state')
+    StateStore.flushAll()
+    self.displayMgr.flushBootFrame()
+    sys.exit(0)
+
   def updating(self, x, y):
+    StateStore.flushAll()
+    self.displayMgr.flushBootFrame()
     self.slideshow.stop(self.updating_continue)
 
   def updating_continue(self):
@@ -127,16 +148,16 @@ class Photoframe:
     route.setupex(*vargs)
     self.webServer.registerHandler(route)
 
-  def setupWebserver(self, listen, port):
-    test = WebServer(port=port, listen=listen)
+  def setupWebserver(self, listen, port, workers):
+    test = WebServer(port=port, listen=listen, workers=workers)
     self.webServer = test
 
     self._loadRoute('settings', 'RouteSettings', self.powerMgr, self.settingsMgr, self.driverMgr, self.timekeeperMgr, self.displayMgr, self.cacheMgr, self.slideshow)
     self._loadRoute('keywords', 'RouteKeywords', self.serviceMgr, self.slideshow)
     self._loadRoute('orientation', 'RouteOrientation', self.cacheMgr)
     self._loadRoute('overscan', 'RouteOverscan', self.cacheMgr)
-    self._loadRoute('maintenance', 'RouteMaintenance', self.emulator, self.driverMgr, self.slideshow)
-    self._loadRoute('details', 'RouteDetails', self.displayMgr, self.driverMgr, self.colormatch, self.slideshow, self.serviceMgr, self.settingsMgr)
+    self._loadRoute('maintenance', 'RouteMaintenance', self.emulator, self.driverMgr, self.slideshow, self.displayMgr)
+    self._loadRoute('details', 'RouteDetails', self.displayMgr, self.driverMgr, self.colormatch, self.slideshow, self.serviceMgr, self.settingsMgr, self.processor)
     self._loadRoute('upload', 'RouteUpload', self.settingsMgr, self.driverMgr)
     self._loadRoute('oauthlink', 'RouteOAuthLink', self.serviceMgr, self.slideshow)
     self._loadRoute('service', 'RouteService', self.serviceMgr, self.slideshow)
@@ -150,18 +171,18 @@ class Photoframe:
       if current is not None:
         logging.info('No display settings, using: %s' % repr(current))
         self.settingsMgr.setUser('tvservice', '%s %s HDMI' % (current['mode'], current['code']))
-        self.settingsMgr.save()
+        self.settingsMgr.save(immediate=True)
       else:
         logging.info('No display attached?')
     if self.settingsMgr.getUser('timezone') == '':
       self.settingsMgr.setUser('timezone', helper.timezoneCurrent())
-      self.settingsMgr.save()
+      self.settingsMgr.save(immediate=True)
 
     width, height, tvservice = self.displayMgr.setConfiguration(self.settingsMgr.getUser('tvservice'), self.settingsMgr.getUser('display-special'))
     self.settingsMgr.setUser('tvservice', tvservice)
     self.settingsMgr.setUser('width',  width)
     self.settingsMgr.setUser('height', height)
-    self.settingsMgr.save()
+    self.settingsMgr.save(immediate=True)
 
   def changeRoot(self, newRoot):
     if newRoot is None: return
@@ -178,6 +199,9 @@ class Photoframe:
 
   def start(self):
     signal.signal(signal.SIGHUP, lambda x, y: self.updating(x,y))
+    signal.signal(signal.SIGTERM, lambda x, y: self.terminate(x,y))
+    atexit.register(StateStore.flushAll)
+    atexit.register(self.displayMgr.flushBootFrame)
     self.slideshow.start()
     self.webServer.start()
 
@@ -21,11 +21,22 @@ try:
 except ImportError:
 	logging.warning('smbus module not available, colormatch will not work')
 	COLORMATCH_DISABLE = True
+try:
+	from PIL import Image
+	COLORMATCH_LUT = True
+except ImportError:
+	logging.warning('PIL module not available, colormatch will depend on colortemp script')
+	COLORMATCH_LUT = False
 import time
 import os
+import math
 import subprocess
+import threading
 
 class colormatch(Thread):
+	REFERENCE = 6500 # Kelvin which leaves the image untouched
+	STEP = 100       # Kelvin between precomputed tables
+
 	def __init__(self, script, min = None, max = None):
 		Thread.__init__(self)
 		self.daemon = True
@@ -36,8 +47,12 @@ class colormatch(Thread):
 		self.void = open(os.devnull, 'wb')
 		self.min = min
 		self.max = max
-		self.listener = None
+		self.listeners = []
+		self.events = None
+		self.published = None
 		self.allowAdjust = False
+		self.luts = {}
+		self.lutLock = threading.Lock()
 		if self.script is not None and self.script != '':
 			self.hasScript = os.path.exists(self.script)
 		else:
@@ -49,6 +64,8 @@ class colormatch(Thread):
 	def setLimits(self, min, max):
 		self.min = min
 		self.max = max
+		with self.lutLock:
+			self.luts = {}
 
 	def hasSensor(self):
 		return self.sensor
@@ -65,11 +82,109 @@ class colormatch(Thread):
 	def getLux(self):
 		return self.lux
 
-	def setUpdateListener(self, listener):
-		self.listener = listener
+	def registerUpdateListener(self, listener):
+		self.listeners.append(listener)
+
+	def setEventManager(self, events):
+		self.events = events
+
+	def _publish(self):
+		# Only when it changes as much as the web UI shows
+		value = (int(round(self.temperature)), round(self.lux, 2))
+		if self.events is None or value == self.published:
+			return
+		self.published = value
+		self.events.publish('color', {'temperature' : self.temperature, 'lux' : self.lux})
+
+	def canTint(self):
+		# True if frames can be adjusted in-process (see tint())
+		return COLORMATCH_LUT and self.allowAdjust and self.hasTemperature()
+
+	def _limit(self, temperature):
+		if self.min is not None and temperature < self.min:
+			temperature = self.min
+		elif self.max is not None and temperature > self.max:
+			temperature = self.max
+		return temperature
+
+	def getTarget(self, temperature=None):
+		# Returns the temperature tint() would actually use
+		if temperature is None:
+			temperature = self.temperature
+		if temperature is None:
+			return None
+		return self.quantize(self._limit(temperature))
+
+	def quantize(self, temperature):
+		# Snaps to the tables we keep, without leaving the min/max range
+		temperature = int(round(float(temperature) / colormatch.STEP)) * colormatch.STEP
+		if self.min is not None:
+			temperature = max(temperature, self.min)
+		if self.max is not None:
+			temperature = min(temperature, self.max)
+		return temperature
+
+	@staticmethod
+	def _kelvinToRGB(kelvin):
+		# Approximation of the blackbody color by Tanner Helland, good from
+		# 1000K to 40000K which is way more than we'll ever need
+		t = kelvin / 100.0
+		if t <= 66:
+			r = 255.0
+			g = 99.4708025861 * math.log(t) - 161.1195681661
+		else:
+			r = 329.698727446 * math.pow(t - 60, -0.1332047592)
+			g = 288.1221695283 * math.pow(t - 60, -0.0755148492)
+		if t >= 66:
+			b = 255.0
+		elif t <= 19:
+			b = 0.0
+		else:
+			b = 138.5177312231 * math.log(t - 10) - 305.0447927307
+		return [min(255.0, max(0.0, c)) for c in [r, g, b]]
+
+	def getLUT(self, temperature, alpha=False):
+		# Returns a table for Image.point() which moves the white point from
+		# REFERENCE to temperature. Tables are computed once per STEP.
+		temperature = self.quantize(temperature)
+		key = (temperature, alpha)
+		with self.lutLock:
+			if key not in self.luts:
+				target = colormatch._kelvinToRGB(temperature)
+				reference = colormatch._kelvinToRGB(colormatch.REFERENCE)
+				gains = [t / r for t, r in zip(target, reference)]
+				# Scale so we never push a channel beyond white
+				peak = max(gains)
+				lut = []
+				for gain in gains:
+					gain = gain / peak
+					lut.extend([int(i * gain + 0.5) for i in range(256)])
+				if alpha:
+					lut.extend(range(256))
+				self.luts[key] = lut
+			return self.luts[key]
+
+	def tint(self, frame, size, format, temperature=None):
+		# Applies the white balance to a raw frame (rgb, bgr, rgba or bgra)
+		# and returns the new frame, or None if it cannot be done.
+		if not COLORMATCH_LUT:
+			return None
+		if temperature is None:
+			temperature = self.temperature
+		if temperature is None:
+			return None
+		temperature = self._limit(temperature)
+		rawmode = format.upper()
+		mode = 'RGBA' if len(format) == 4 else 'RGB'
+		try:
+			image = Image.frombuffer(mode, size, frame, 'raw', rawmode, 0, 1)
+			return image.point(self.getLUT(temperature, mode == 'RGBA')).tobytes('raw', rawmode)
+		except:
+			logging.exception('Unable to adjust color temperature of frame')
+			return None
 
 	def adjust(self, filename, filenameTemp, temperature=None):
-		if not self.allowAdjust or not self.hasScript:
+		if not self.allowAdjust or not (self.hasScript or COLORMATCH_LUT):
 			return False
 
 		if self.temperature is None or self.sensor is None:
@@ -77,14 +192,21 @@ class colormatch(Thread):
 			return False
 		if temperature is None:
 			temperature = self.temperature
-		if self.min is not None and temperature < self.min:
-			logging.debug('Actual color temp measured is %d, but we cap to %dK' % (temperature, self.min))
-			temperature = self.min
-		elif self.max is not None and temperature > self.max:
-			logging.debug('Actual color temp measured is %d, but we cap to %dK' % (temperature, self.max))
-			temperature = self.max
-		else:
-			logging.debug('Adjusting color temperature to %dK' % temperature)
+		if self._limit(temperature) != temperature:
+			logging.debug('Actual color temp measured is %d, but we cap to %dK' % (temperature, self._limit(temperature)))
+		temperature = self._limit(temperature)
+		logging.debug('Adjusting color temperature to %dK' % temperature)
+
+		if COLORMATCH_LUT:
+			try:
+				image = Image.open(filename)
+				image = image.convert('RGB').point(self.getLUT(temperature))
+				image.save(filenameTemp, 'PNG')
+				return True
+			except:
+				logging.exception('Unable to adjust color temperature of "%s"', filename)
+				if not self.hasScript:
+					return False
 
 		try:
 			result = subprocess.call([self.script, '-t', "%d" % temperature, filename + '[0]', filenameTemp], stderr=self.void) == 0
@@ -155,11 +277,12 @@ class colormatch(Thread):
 		ver = bus.read_byte(0x29)
 		# version # should be 0x44
 		if ver == 0x44:
-			# Make sure we have the needed script
-			if not os.path.exists(self.script):
+			# Without PIL, we need the script
+			if not COLORMATCH_LUT and not self.hasScript:
 				logging.info('No color temperature script, download it from http://www.fmwconcepts.com/imagemagick/colortemp/index.php and save as "%s"' % self.script)
 				self.allowAdjust = False
-			self.allowAdjust = True
+			else:
+				self.allowAdjust = True
 
 			bus.write_byte(0x29, 0x80|0x00) # 0x00 = ENABLE register
 			bus.write_byte(0x29, 0x01|0x02) # 0x01 = Power on, 0x02 RGB sensors enabled
@@ -181,8 +304,12 @@ class colormatch(Thread):
 					self.temperature = 0
 					self.lux = 0
 
-				if self.listener:
-					self.listener(self.temperature, self.lux)
+				for listener in self.listeners:
+					try:
+						listener(self.temperature, self.lux)
+					except:
+						logging.exception('Update listener %s failed', repr(listener))
+				self._publish()
 
 				time.sleep(1)
 		else:
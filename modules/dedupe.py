@@ -13,32 +13,191 @@
 # You should have received a copy of the GNU General Public License
 # along with photoframe.  If not, see <http://www.gnu.org/licenses/>.
 #
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
 
+from modules.statestore import StateStore
+
+# Finds the same photo across albums and services, even if it has been
+# scaled or recompressed along the way.
+#
+# Every image gets a 64bit perceptual hash the first time we have the
+# file (local files when considered, remote ones when downloaded). The
+# hashes are kept in an index keyed by cache id, so on the next round a
+# duplicate can be skipped before it's even downloaded.
+#
+# Images shown during this round are kept in a BK-tree, which finds all
+# hashes within THRESHOLD bits without comparing against every entry.
+#
 class DedupeManager:
+  THRESHOLD = 6 # Bits which may differ for two images to be considered the same
+  MAX_HASHES = 50000 # Oldest hashes are dropped beyond this
+
+  class BKTree:
+    def __init__(self, distance):
+      self.distance = distance
+      self.root = None
+
+    def add(self, value, key):
+      # Nodes are [value, keys, {distance : child}]
+      if self.root is None:
+        self.root = [value, [key], {}]
+        return
+      node = self.root
+      while True:
+        d = self.distance(value, node[0])
+        if d == 0:
+          if key not in node[1]:
+            node[1].append(key)
+          return
+        child = node[2].get(d, None)
+        if child is None:
+          node[2][d] = [value, [key], {}]
+          return
+        node = child
+
+    def find(self, value, limit):
+      # Returns the keys of all values within limit
+      result = []
+      if self.root is None:
+        return result
+      pending = [self.root]
+      while pending:
+        node = pending.pop()
+        d = self.distance(value, node[0])
+        if d <= limit:
+          result.extend(node[1])
+        for dist in node[2]:
+          if d - limit <= dist <= d + limit:
+            pending.append(node[2][dist])
+      return result
+
   def __init__(self, memoryLocation):
+    self.algorithm = None
     try:
       from PIL import Image
-      import imagehash
-      self.hasImageHash = True
-      logging.info('ImageHash functionality is available')
+      self.Image = Image
+      self.algorithm = 'dhash'
+      try:
+        import imagehash
+        self.imagehash = imagehash
+        self.algorithm = 'phash'
+        logging.info('ImageHash functionality is available')
+      except ImportError:
+        logging.info('ImageHash functionality is unavailable, using built-in hash')
+    except ImportError:
+      logging.info('PIL is unavailable, duplicate images will not be detected')
+
+    self.lock = threading.Lock()
+    self.hashes = OrderedDict() # Oldest first
+    self.shown = set()
+    self.tree = DedupeManager.BKTree(self._hamming)
+    self.filename = os.path.join(memoryLocation, 'dedupe.json')
+    self.store = StateStore(self.filename, self._getIndex)
+    self._load()
+
+  def isEnabled(self):
+    return self.algorithm is not None
+
+  def _load(self):
+    if not os.path.exists(self.filename):
+      return
+    try:
+      with open(self.filename, 'r') as f:
+        data = json.load(f, object_pairs_hook=OrderedDict)
     except:
-      self.hasImageHash = False
-      logging.info('ImageHash functionality is unavailable')
-
-  def _hamming_distance(self, i1, i2):
-      x = i1 ^ i2
-      setBits = 0
-
-      while (x > 0):
-          setBits += x & 1
-          x >>= 1
-
-      return setBits
-
-  def _hamming(self, s1, s2):
-      h = 0
-      for i in range(0, len(s1)/2):
-          i1 = int(s1[i*2:i*2+2], 16)
-          i2 = int(s2[i*2:i*2+2], 16)
-          h += self._hamming_distance(i1, i2)
-      return h
+      logging.exception('Unable to load dedupe index, starting over')
+      return
+    if data.get('algorithm', None) != self.algorithm:
+      logging.info('Hashing has changed, dedupe index will be rebuilt')
+      return
+    for key in data['hashes']:
+      self.hashes[key] = int(data['hashes'][key], 16)
+
+  def _getIndex(self):
+    with self.lock:
+      hashes = OrderedDict()
+      for key in self.hashes:
+        hashes[key] = '%016x' % self.hashes[key]
+    return {'algorithm' : self.algorithm, 'hashes' : hashes}
+
+  def _hamming(self, h1, h2):
+    return bin(h1 ^ h2).count('1')
+
+  def _dhash(self, image):
+    # Compares each pixel with its neighbour on a 9x8 grayscale thumbnail
+    pixels = list(image.convert('L').resize((9, 8), self.Image.ANTIALIAS).getdata())
+    value = 0
+    for y in range(0, 8):
+      for x in range(0, 8):
+        value = (value << 1) | (pixels[y * 9 + x] > pixels[y * 9 + x + 1])
+    return value
+
+  def computeHash(self, filename):
+    try:
+      image = self.Image.open(filename)
+      # JPEGs can be decoded at a fraction of the size, plenty for hashing
+      image.draft('RGB', (256, 256))
+      if self.algorithm == 'phash':
+        return int(str(self.imagehash.phash(image)), 16)
+      return self._dhash(image)
+    except:
+      logging.exception('Unable to hash "%s"', filename)
+      return None
+
+  def getHash(self, key):
+    with self.lock:
+      return self.hashes.get(key, None)
+
+  def add(self, key, filename):
+    # Hashes the file unless we already know it, returns the hash
+    if not self.isEnabled() or key is None:
+      return None
+    value = self.getHash(key)
+    if value is not None:
+      return value
+    value = self.computeHash(filename)
+    if value is None:
+      return None
+    with self.lock:
+      self.hashes[key] = value
+      while len(self.hashes) > DedupeManager.MAX_HASHES:
+        self.hashes.popitem(last=False)
+    self.store.markDirty()
+    return value
+
+  def forget(self, key):
+    with self.lock:
+      self.hashes.pop(key, None)
+    self.store.markDirty()
+
+  def isDuplicate(self, key):
+    # True if an image which looks the same as key was shown this round
+    with self.lock:
+      if key in self.shown:
+        # Same photo reached through another keyword (album and "latest", ...)
+        return True
+      value = self.hashes.get(key, None)
+      if value is None:
+        return False
+      for other in self.tree.find(value, DedupeManager.THRESHOLD):
+        if other != key:
+          return True
+    return False
+
+  def markShown(self, key):
+    with self.lock:
+      value = self.hashes.get(key, None)
+      if value is None or key in self.shown:
+        return
+      self.shown.add(key)
+      self.tree.add(value, key)
+
+  def reset(self):
+    # Starts a new round, the hashes are kept
+    with self.lock:
+      self.shown = set()
+      self.tree = DedupeManager.BKTree(self._hamming)
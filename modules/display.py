@@ -19,12 +19,25 @@ import logging
 import time
 import re
 import json
+import threading
+import collections
 import debug
 
 from sysconfig import sysconfig
 from helper import helper
+from path import path
+from statestore import StateStore
+from textrender import TextRenderer
+from transition import Transition
 
 class display:
+  SNAPSHOT_CACHE = 4 # Number of snapshot sizes kept for the current frame
+  MESSAGE_CACHE = 4  # Number of rendered status screens kept around
+  RETINT_HYSTERESIS = 200 # Kelvin the ambient light must move before we re-tint
+  RETINT_STEPS = 5        # Frames used to fade into the new tint, 1 for none
+  RETINT_DELAY = 0.1      # Seconds between those frames
+  BOOTFRAME_INTERVAL = 600 # Seconds between saving what's shown for the next boot (SD cards wear)
+
   def __init__(self, use_emulator=False, emulate_width=1280, emulate_height=720):
     self.void = open(os.devnull, 'wb')
     self.params = None
@@ -40,6 +53,31 @@ class display:
       logging.info('Using framebuffer emulation')
     self.lastMessage = None
 
+    # Last frame we rendered (in self.format) and the JPEG snapshots made from it
+    self.lock = threading.Lock()
+    self.frame = None
+    self.frameId = 0
+    self.frameEpoch = '%x' % int(time.time())
+    self.snapshots = {}
+
+    self.text = TextRenderer()
+    self.messages = collections.OrderedDict()
+    self.colormatch = None
+    # Untinted version of the current image and the temperature applied to it
+    self.source = None
+    self.sourceTemperature = None
+    self.renderLock = threading.RLock()
+
+    # What we showed before a restart (header, frame) until the first new image,
+    # and the last image shown which hasn't been saved for the next boot yet
+    self.bootFrame = None
+    self.bootShown = False
+    self.bootPending = None
+    self.bootSaved = 0
+
+  def setColormatch(self, colormatch):
+    self.colormatch = colormatch
+
   def setConfigPage(self, url):
     self.url = url
 
@@ -103,7 +141,23 @@ class display:
   def isHDMI(self):
     return self.getDevice() == '/dev/fb0' and not display._isDPI()
 
-  def get(self):
+  def getSnapshotTag(self, width=None):
+    # Identifies what get() would return, usable as an ETag
+    if width is None:
+      width = 0
+    if not self.enabled:
+      return '"off-%d"' % width
+    return '"%s-%d-%d"' % (self.frameEpoch, self.frameId, width)
+
+  def get(self, width=None):
+    # Returns a JPEG of what's on screen, optionally scaled down to width.
+    # It's made from the frame we rendered, only once per frame and width.
+    with self.lock:
+      tag = self.getSnapshotTag(width)
+      if tag in self.snapshots:
+        return (self.snapshots[tag], 'image/jpeg', tag)
+      frame = self.frame
+
     if self.enabled:
       args = [
               'convert',
@@ -111,8 +165,7 @@ class display:
               '8',
               '-size',
               '%dx%d' % (self.width+self.xoffset, self.height+self.yoffset),
-              '%s:-' % (self.format),
-              'jpg:-'
+              '%s:-' % (self.format)
       ]
     else:
       args = [
@@ -131,13 +184,31 @@ class display:
         '32',
         'label:%s' % "Display off",
         '-depth',
-        '8',
-        'jpg:-'
+        '8'
       ]
+    if width is not None:
+      args.extend(['-resize', '%dx>' % width])
+    args.append('jpg:-')
 
     if not self.enabled:
       result = debug.subprocess_check_output(args, stderr=self.void)
-    elif self.depth in [24, 32]:
+    elif frame is not None:
+      pip = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.void)
+      result = pip.communicate(frame)[0]
+    else:
+      # Nothing rendered by us yet, so read it back from the framebuffer
+      result = self._grab(args)
+
+    with self.lock:
+      if tag == self.getSnapshotTag(width):
+        if len(self.snapshots) >= display.SNAPSHOT_CACHE:
+          self.snapshots = {}
+        self.snapshots[tag] = result
+    return (result, 'image/jpeg', tag)
+
+  def _grab(self, args):
+    result = None
+    if self.depth in [24, 32]:
       device = self.getDevice()
       if self.emulate:
         device = '/tmp/fb.bin'
@@ -152,38 +223,236 @@ class display:
         result = pip.communicate()[0]
     else:
       logging.error('Do not know how to grab this kind of framebuffer')
-    return (result, 'image/jpeg')
+    return result
+
+  def _setFrame(self, frame, source=None, temperature=None):
+    with self.lock:
+      self.frame = frame
+      self.source = source
+      self.sourceTemperature = temperature
+      self.frameId += 1
+      self.snapshots = {}
+    self.lastMessage = None
+    self.bootShown = False
+
+  def _to_display(self, arguments, transition='none', duration=0):
+    # Render into memory first, the frame is kept for snapshots
+    try:
+      frame = debug.subprocess_check_output(arguments, stderr=self.void)
+    except subprocess.CalledProcessError:
+      logging.exception('Unable to render frame')
+      return
+    self._present(frame, transition, duration)
+
+  def _present(self, frame, transition='none', duration=0):
+    # Tints (if possible) and shows an untinted frame
+    self.bootFrame = None
+    with self.renderLock:
+      temperature = None
+      tinted = None
+      if self.colormatch is not None and self.colormatch.canTint():
+        temperature = self.colormatch.getTarget()
+        tinted = self._tint(frame, temperature)
+      if tinted is None:
+        tinted = frame
+        temperature = None
+      self._transition(tinted, transition, duration)
+      self._blit(tinted, frame, temperature)
+    self._saveBootFrame(tinted)
+
+  def _saveBootFrame(self, frame=None):
+    # Keeps what's shown (as written to the framebuffer) so it can be put
+    # on screen the moment we start next time, see restoreBootFrame()
+    if frame is not None:
+      self.bootPending = frame
+      if time.time() - self.bootSaved < display.BOOTFRAME_INTERVAL:
+        return
+    frame = self.bootPending
+    if frame is None:
+      return
+    self.bootPending = None
+    self.bootSaved = time.time()
+    header = {
+      'device' : self.getDevice(),
+      'width' : self.width + self.xoffset,
+      'height' : self.height + self.yoffset,
+      'depth' : self.depth,
+      'format' : self.format,
+      'size' : len(frame)
+    }
+    try:
+      with open(path.BOOTFRAME + '.raw.tmp', 'wb') as f:
+        f.write(frame)
+      os.rename(path.BOOTFRAME + '.raw.tmp', path.BOOTFRAME + '.raw')
+      StateStore.writeAtomic(path.BOOTFRAME + '.json', header)
+    except:
+      logging.exception('Unable to save frame for next boot')
+
+  def flushBootFrame(self):
+    self._saveBootFrame()
+
+  def restoreBootFrame(self):
+    # Runs before anything is configured, so all we know comes from the
+    # header. Only shown if the framebuffer is still set up the same way.
+    try:
+      with open(path.BOOTFRAME + '.json', 'r') as f:
+        header = json.load(f)
+      with open(path.BOOTFRAME + '.raw', 'rb') as f:
+        frame = f.read()
+    except:
+      logging.debug('No frame from last boot')
+      return False
+    if len(frame) != header['size']:
+      logging.warning('Frame from last boot is incomplete, ignoring it')
+      return False
+
+    device = header['device']
+    if self.emulate:
+      device = '/tmp/fb.bin'
+    elif not display._fbMatches(device, header):
+      logging.info('Framebuffer has changed since last boot, not showing last frame')
+      return False
+    self._write(device, header['depth'], frame)
+    self._setFrame(frame)
+    self.bootFrame = (header, frame)
+    self.bootShown = True
+    logging.info('Showing last frame from previous boot')
+    return True
+
+  def _reblitBootFrame(self):
+    # Changing the mode wipes the framebuffer, put it back if it still fits
+    if self.bootFrame is None:
+      return
+    header, frame = self.bootFrame
+    if header['width'] != self.width + self.xoffset or header['height'] != self.height + self.yoffset or header['depth'] != self.depth or header['format'] != self.format:
+      self.bootFrame = None
+      return
+    self._blit(frame)
+    self.bootShown = True
+
+  def hasBootFrame(self):
+    return self.bootShown
+
+  @staticmethod
+  def _fbMatches(device, header):
+    # Cheap check using sysfs, no need to run fbset
+    sysfs = '/sys/class/graphics/%s' % os.path.basename(device)
+    try:
+      with open(sysfs + '/virtual_size', 'r') as f:
+        size = f.read().strip()
+      with open(sysfs + '/bits_per_pixel', 'r') as f:
+        depth = int(f.read().strip())
+    except:
+      return False
+    return size == '%d,%d' % (header['width'], header['height']) and depth == header['depth']
+
+  def getRendered(self):
+    # The untinted frame on screen and its geometry, None if there's none
+    with self.lock:
+      if self.source is None:
+        return None
+      return {'frame' : self.source, 'width' : self.width + self.xoffset, 'height' : self.height + self.yoffset, 'format' : self.format}
 
-  def _to_display(self, arguments):
+  def showFrame(self, rendered, transition='none', duration=0):
+    # Shows a frame from getRendered() again, returns False if it no longer
+    # fits the display (resolution or format changed)
+    if not self.enabled:
+      logging.debug('Don\'t bother, display is off')
+      return True
+    if rendered['width'] != self.width + self.xoffset or rendered['height'] != self.height + self.yoffset or rendered['format'] != self.format:
+      return False
+    self._present(rendered['frame'], transition, duration)
+    return True
+
+  def _transition(self, frame, mode, duration):
+    with self.lock:
+      previous = self.frame
+    if previous is None or duration <= 0 or not Transition.isSupported(mode, self.depth):
+      return
+    device = self.getDevice()
+    if self.emulate:
+      device = '/tmp/fb.bin'
+    Transition.run(device, mode, previous, frame, (self.width + self.xoffset, self.height + self.yoffset), self.format, duration)
+
+  def _tint(self, frame, temperature):
+    return self.colormatch.tint(frame, (self.width + self.xoffset, self.height + self.yoffset), self.format, temperature)
+
+  def _blit(self, frame, source=None, temperature=None):
     device = self.getDevice()
     if self.emulate:
       device = '/tmp/fb.bin'
       self.depth = 32
 
-    if self.depth in [24, 32]:
+    if not self._write(device, self.depth, frame):
+      return
+    self._setFrame(frame, source, temperature)
+
+  def _write(self, device, depth, frame):
+    if depth in [24, 32]:
       with open(device, 'wb') as f:
-        debug.subprocess_call(arguments, stdout=f, stderr=self.void)
-    elif self.depth == 16: # Typically RGB565
-      # For some odd reason, cannot pipe the output directly to the framebuffer, use temp file
+        f.write(frame)
+    elif depth == 16: # Typically RGB565
       with open(device, 'wb') as fb:
-        src = subprocess.Popen(arguments, stdout=subprocess.PIPE, stderr=self.void)
-        pip = subprocess.Popen(['/root/photoframe/rgb565/rgb565'], stdin=src.stdout, stdout=fb)
-        src.stdout.close()
-        pip.communicate()
+        pip = subprocess.Popen(['/root/photoframe/rgb565/rgb565'], stdin=subprocess.PIPE, stdout=fb)
+        pip.communicate(frame)
     else:
-      logging.error('Do not know how to render this, depth is %d', self.depth)
-
-    self.lastMessage = None
+      logging.error('Do not know how to render this, depth is %d', depth)
+      return False
+    return True
+
+  def colorListener(self, temperature, lux):
+    # Called by colormatch whenever the sensor has been read, re-tints the
+    # image on screen once the ambient light has changed enough
+    if not self.enabled or self.colormatch is None or not self.colormatch.canTint():
+      return
+    target = self.colormatch.getTarget(temperature)
+    with self.renderLock:
+      source = self.source
+      current = self.sourceTemperature
+      if source is None or current is None or abs(target - current) < display.RETINT_HYSTERESIS:
+        return
+      logging.debug('Ambient light changed, re-tinting from %dK to %dK', current, target)
+      steps = max(1, display.RETINT_STEPS)
+      for step in range(1, steps + 1):
+        intermediate = current + (target - current) * step / steps
+        tinted = self._tint(source, intermediate)
+        if tinted is None:
+          return
+        self._blit(tinted, source, intermediate)
+        if step < steps:
+          time.sleep(display.RETINT_DELAY)
 
   def message(self, message, showConfig=True):
     if not self.enabled:
       logging.debug('Don\'t bother, display is off')
       return
 
-    url = 'caption:'
-    if helper.getDeviceIp() is not None and showConfig:
-      url = 'caption:Configuration available at http://%s:7777' % helper.getDeviceIp()
+    footer = ''
+    if showConfig:
+      ip = helper.getDeviceIp()
+      if ip is not None:
+        footer = 'Configuration available at http://%s:7777' % ip
+
+    key = (message, footer, self.width, self.height, self.xoffset, self.yoffset, self.format)
+    if self.lastMessage == key:
+      return
 
+    frame = self.messages.pop(key, None)
+    if frame is None:
+      frame = self.text.render(message, footer, self.width, self.height, self.xoffset, self.yoffset, self.format)
+    if frame is None:
+      frame = self._renderMessage(message, footer)
+      if frame is None:
+        return
+
+    self.messages[key] = frame
+    while len(self.messages) > display.MESSAGE_CACHE:
+      self.messages.popitem(last=False)
+    with self.renderLock:
+      self._blit(frame)
+    self.lastMessage = key
+
+  def _renderMessage(self, message, footer):
     args = [
       'convert',
       '-size',
@@ -205,7 +474,7 @@ class display:
       'south',
       '-fill',
       '#666666',
-      url,
+      'caption:%s' % footer,
       '-flatten',
       '-extent',
       '%dx%d+%d+%d' % (self.width + self.xoffset, self.height + self.yoffset, self.xoffset, self.yoffset),
@@ -213,12 +482,13 @@ class display:
       '8',
       '%s:-' % self.format
     ]
+    try:
+      return debug.subprocess_check_output(args, stderr=self.void)
+    except subprocess.CalledProcessError:
+      logging.exception('Unable to render message')
+      return None
 
-    if self.lastMessage != message:
-      self._to_display(args)
-      self.lastMessage = message
-
-  def image(self, filename):
+  def image(self, filename, transition='none', duration=0):
     if not self.enabled:
       logging.debug('Don\'t bother, display is off')
       return
@@ -227,6 +497,7 @@ class display:
     args = [
       'convert',
       filename + '[0]',
+      '-auto-orient',
       '-background',
       'black',
       '-gravity',
@@ -237,7 +508,7 @@ class display:
       '8',
       '%s:-' % self.format
     ]
-    self._to_display(args)
+    self._to_display(args, transition, duration)
 
   def enable(self, enable, force=False):
     if enable == self.enabled and not force:
@@ -255,9 +526,12 @@ class display:
           time.sleep(1)
           debug.subprocess_call(['/bin/fbset', '-fb', self.getDevice(), '-depth', '8'], stderr=self.void)
           debug.subprocess_call(['/bin/fbset', '-fb', self.getDevice(), '-depth', str(self.depth), '-xres', str(self.width), '-yres', str(self.height), '-vxres', str(self.width), '-vyres', str(self.height)], stderr=self.void)
+          self._reblitBootFrame()
         else:
           debug.subprocess_call(['/usr/bin/vcgencmd', 'display_power', '1'], stderr=self.void)
     else:
+      # What was shown last is a better start than the next image
+      self.flushBootFrame()
       self.clear()
       if self.isHDMI():
         debug.subprocess_call(['/usr/bin/vcgencmd', 'display_power', '0'], stderr=self.void)
@@ -272,6 +546,7 @@ class display:
       return
     with open(self.getDevice(), 'wb') as f:
       debug.subprocess_call(['cat' , '/dev/zero'], stdout=f, stderr=self.void)
+    self._setFrame(None)
 
   @staticmethod
   def _isDPI():
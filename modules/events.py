@@ -14,45 +14,76 @@
 # along with photoframe.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import threading
+from collections import deque
+
+# Keeps the last CAPACITY events in id order. Clients either poll using
+# getSince() or block in wait() (see the /events/stream route) to have
+# them pushed as they happen.
+#
+# TYPE_STATE events describe the current state of something (which slide
+# is shown, ambient color, ...), publishing a new one replaces the old.
 class Events:
   TYPE_PERSIST = 1
   TYPE_NORMAL = 0
+  TYPE_STATE = 2
 
   LEVEL_INFO = 0
   LEVEL_WARN = 1
   LEVEL_ERR = 2
   LEVEL_DEBUG = 3
 
+  CAPACITY = 200
+
   def __init__(self):
+    self.lock = threading.Condition()
     self.idcount = 0
-    self.msgs = []
+    self.msgs = deque(maxlen=Events.CAPACITY)
 
-  def add(self, message, unique=None, link=None, level=LEVEL_INFO, type=TYPE_NORMAL):
-    record = {'id': self.idcount, 'unique' : unique, 'type' : type, 'level' : level, 'message' : message, 'link' : link}
+  def add(self, message, unique=None, link=None, level=LEVEL_INFO, type=TYPE_NORMAL, data=None):
     if unique is not None:
       unique = repr(unique) # Make it a string to be safe
-      for i in range(0, len(self.msgs)):
-        if self.msgs[i]['unique'] == unique:
-          self.msgs[i] = record
-          record = None
-          break
-
-    if record is not None:
+    with self.lock:
+      record = {'id': self.idcount, 'unique' : unique, 'type' : type, 'level' : level, 'message' : message, 'link' : link, 'data' : data}
+      if unique is not None:
+        # Replaced events move to the end, so ids stay in order
+        for msg in self.msgs:
+          if msg['unique'] == unique:
+            self.msgs.remove(msg)
+            break
       self.msgs.append(record)
-    self.idcount += 1
+      self.idcount += 1
+      self.lock.notifyAll()
+
+  def publish(self, topic, data, key=None):
+    # key tells apart things sharing a topic (like one state per service)
+    self.add(topic, unique=('state', topic, key), type=Events.TYPE_STATE, data=data)
 
   def remove(self, id):
-    for i in range(0, len(self.msgs)):
-      if self.msgs[i]['id'] == id and self.msgs[i]['type'] != Events.TYPE_PERSIST:
-        self.msgs.pop(i)
-        break
+    with self.lock:
+      for msg in self.msgs:
+        if msg['id'] == id and msg['type'] != Events.TYPE_PERSIST:
+          self.msgs.remove(msg)
+          break
 
   def getAll(self):
-    return self.msgs
+    with self.lock:
+      return list(self.msgs)
 
   def getSince(self, id):
-    ret = []
-    for msg in self.msgs:
-      if msg['id'] > id:
+    # Only walks the events which are newer
+    with self.lock:
+      ret = []
+      for msg in reversed(self.msgs):
+        if msg['id'] <= id:
+          break
         ret.append(msg)
-    return ret
+      ret.reverse()
+      return ret
+
+  def wait(self, id, timeout):
+    # Like getSince(), but waits up to timeout seconds for something new
+    with self.lock:
+      if self.idcount - 1 <= id:
+        self.lock.wait(timeout)
+      return self.getSince(id)
@@ -21,6 +21,8 @@ import shutil
 import re
 import random
 import time
+import hashlib
+import struct
 
 try:
 	import netifaces
@@ -39,6 +41,8 @@ VALID_URL_REGEX = re.compile(
 class helper:
 	TOOL_ROTATE = '/usr/bin/jpegtran'
 	NETWORK_CHECK = True
+	DIGEST_CACHE = 50000 # Number of digests we remember, see hashString()
+	_DIGESTS = {}
 
 	MIMETYPES = {
 		'image/jpeg' : 'jpg',
@@ -49,6 +53,24 @@ class helper:
 	}
 
 
+	@staticmethod
+	def hashString(text):
+		# SHA1 of text as utf-8, the same text (keywords, item ids) gets
+		# hashed over and over again, so remember the result
+		digest = helper._DIGESTS.get(text, None)
+		if digest is None:
+			if type(text) is not unicode:
+				# make sure it's unicode
+				a = text.decode('ascii', errors='replace')
+			else:
+				a = text
+			a = a.encode('utf-8', errors='replace')
+			digest = hashlib.sha1(a).hexdigest()
+			if len(helper._DIGESTS) >= helper.DIGEST_CACHE:
+				helper._DIGESTS.clear()
+			helper._DIGESTS[text] = digest
+		return digest
+
 	@staticmethod
 	def isValidUrl(url):
 		# Catches most invalid URLs
@@ -193,8 +215,66 @@ class helper:
 		imageSize["width"] = int(m.group(1))
 		imageSize["height"] = int(m.group(2))
 
+		# Report the size as it will be shown, not as it was stored
+		if helper.getOrientation(filename) >= 5:
+			imageSize["width"], imageSize["height"] = imageSize["height"], imageSize["width"]
 		return imageSize
 
+	@staticmethod
+	def getOrientation(filename):
+		# Returns the EXIF orientation (1-8, where 1 means as-is) by walking
+		# the JPEG markers, only the header is read.
+		try:
+			with open(filename, 'rb') as f:
+				if f.read(2) != '\xff\xd8':
+					return 1
+				while True:
+					marker = f.read(2)
+					if len(marker) != 2 or marker[0] != '\xff':
+						return 1
+					if marker[1] == '\xff':
+						# Fill byte, marker starts at the next one
+						f.seek(-1, 1)
+						continue
+					if marker[1] in ['\xda', '\xd9']:
+						# Image data begins, no EXIF to be found
+						return 1
+					if marker[1] == '\x01' or '\xd0' <= marker[1] <= '\xd8':
+						continue
+					length = struct.unpack('>H', f.read(2))[0]
+					if marker[1] == '\xe1':
+						data = f.read(length - 2)
+						if data[0:6] == 'Exif\x00\x00':
+							return helper._parseOrientation(data[6:])
+					else:
+						f.seek(length - 2, 1)
+		except:
+			logging.exception('Unable to read orientation of %s', filename)
+		return 1
+
+	@staticmethod
+	def _parseOrientation(tiff):
+		try:
+			if tiff[0:2] == 'II':
+				endian = '<'
+			elif tiff[0:2] == 'MM':
+				endian = '>'
+			else:
+				return 1
+			offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+			count = struct.unpack(endian + 'H', tiff[offset:offset+2])[0]
+			for i in range(0, count):
+				entry = offset + 2 + i * 12
+				tag = struct.unpack(endian + 'H', tiff[entry:entry+2])[0]
+				if tag == 0x0112:
+					value = struct.unpack(endian + 'H', tiff[entry+8:entry+10])[0]
+					if value >= 1 and value <= 8:
+						return value
+					return 1
+		except struct.error:
+			logging.warning('EXIF data is truncated, assuming no orientation')
+		return 1
+
 	@staticmethod
 	def makeFullframe(filename, displayWidth, displayHeight, zoomOnly=False, autoChoose=False):
 		imageSize = helper.getImageSize(filename)
@@ -272,6 +352,7 @@ class helper:
 				cmd = [
 					'convert',
 					filename + '[0]',
+					'-auto-orient',
 					'-resize',
 					'%sx%s' % (adjWidth, adjHeight),
 					'-gravity',
@@ -285,6 +366,7 @@ class helper:
 				cmd = [
 					'convert',
 					filename + '[0]',
+					'-auto-orient',
 					'-resize',
 					resizeString % (displayWidth, displayHeight),
 					'-gravity',
@@ -298,6 +380,7 @@ class helper:
 					'-20x0',
 					'(',
 					filename + '[0]',
+					'-auto-orient',
 					'-bordercolor',
 					'black',
 					'-border',
@@ -377,28 +460,26 @@ class helper:
 
 	@staticmethod
 	def autoRotate(ifile):
-		if not os.path.exists('/usr/bin/jpegexiforient'):
-			logging.warning('jpegexiforient is missing, no auto rotate available. Did you forget to run "apt install libjpeg-turbo-progs" ?')
+		# Writes a rotated copy of the image. Not needed when the image goes
+		# through convert with -auto-orient (makeFullframe, display), which
+		# does it as part of the decode.
+		orient = helper.getOrientation(ifile) - 1
+		if orient == 0:
+			return ifile
+		if not os.path.exists(helper.TOOL_ROTATE):
+			logging.warning('jpegtran is missing, no auto rotate available. Did you forget to run "apt install libjpeg-turbo-progs" ?')
 			return ifile
 
 		p, f = os.path.split(ifile)
 		ofile = os.path.join(p, "rotated_" + f)
 
-		# First, use jpegexiftran to determine orientation
 		parameters = ['', '-flip horizontal', '-rotate 180', '-flip vertical', '-transpose', '-rotate 90', '-transverse', '-rotate 270']
+		cmd = [helper.TOOL_ROTATE]
+		cmd.extend(parameters[orient].split())
+		cmd.extend(['-outfile', ofile, ifile])
 		with open(os.devnull, 'wb') as void:
-			result = subprocess.check_output(['/usr/bin/jpegexiforient', ifile]) #, stderr=void)
-		if result:
-			orient = int(result)-1
-			if orient < 0 or orient >= len(parameters):
-				logging.info('Orientation was %d, not transforming it', orient)
-				return ifile
-			cmd = [helper.TOOL_ROTATE]
-			cmd.extend(parameters[orient].split())
-			cmd.extend(['-outfile', ofile, ifile])
-			with open(os.devnull, 'wb') as void:
-				result = subprocess.check_call(cmd, stderr=void)
-			if result == 0:
-				os.unlink(ifile)
-				return ofile
+			result = subprocess.check_call(cmd, stderr=void)
+		if result == 0:
+			os.unlink(ifile)
+			return ofile
 		return ifile
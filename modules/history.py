@@ -16,60 +16,134 @@
 
 import logging
 import os
-import shutil
+import json
+import time
+import zlib
+import threading
+from collections import deque
 
 from modules.path import path as syspath
+from modules.statestore import StateStore
 
+# Keeps the frames which have been shown, as rendered by the display (but
+# before any tinting), so going back in history is just a matter of
+# putting them on screen again.
+#
+# Frames are compressed and stored in HISTORYFOLDER together with an index
+# so history survives a restart. Once the frames use more than the
+# 'history-size' setting (megabytes), the oldest ones are dropped. If it's
+# zero, the last FRAMES frames are kept no matter their size.
 class ImageHistory:
-  MAX_HISTORY = 20
+  INDEX = 'index.json'
+  COMPRESSION = 1 # Frames are large and the Pi is slow, favor speed
+  FRAMES = 20
+  INDEX_DELAY = 600 # Seconds, frames which aren't in the index are dropped on load
+
   def __init__(self, settings):
-    self._HISTORY = []
     self.settings = settings
+    self.lock = threading.Lock()
+    self._HISTORY = deque() # Newest first
+    self.sequence = 0
+    self._STORE = StateStore(self._indexFile(), self._entries, maxDelay=ImageHistory.INDEX_DELAY)
 
-    # Also, make sure folder exists AND clear any existing content
     if not os.path.exists(syspath.HISTORYFOLDER):
       os.mkdir(syspath.HISTORYFOLDER)
+    self._load()
+
+  def _indexFile(self):
+    return os.path.join(syspath.HISTORYFOLDER, ImageHistory.INDEX)
 
-    # Clear it
-    for p, _dirs, files in os.walk(syspath.HISTORYFOLDER):
-      for filename in [os.path.join(p, f) for f in files]:
+  def _load(self):
+    entries = []
+    if os.path.exists(self._indexFile()):
+      try:
+        with open(self._indexFile(), 'r') as f:
+          entries = json.load(f)
+      except:
+        logging.exception('History index is corrupt, starting over')
+    entries = [e for e in entries if os.path.exists(os.path.join(syspath.HISTORYFOLDER, e['file']))]
+    self._HISTORY = deque(entries)
+    if len(entries) > 0:
+      self.sequence = max([e['sequence'] for e in entries]) + 1
+
+    # Anything else (older versions kept plain copies) is of no use
+    known = set([e['file'] for e in entries] + [ImageHistory.INDEX])
+    for filename in os.listdir(syspath.HISTORYFOLDER):
+      if filename not in known:
         try:
-          os.unlink(filename)
+          os.unlink(os.path.join(syspath.HISTORYFOLDER, filename))
         except:
           logging.exception('Failed to delete "%s"' % filename)
+    logging.info('History has %d frames', len(self._HISTORY))
+    with self.lock:
+      self._obeyLimits()
+    self._STORE.markDirty()
 
-  def _find(self, file):
-    return next((entry for entry in self._HISTORY if entry.filename == file), None)
+  def _entries(self):
+    # Called by the store, which may flush from within markDirty(), so
+    # never call that while holding the lock
+    with self.lock:
+      return list(self._HISTORY)
 
-  def add(self, image):
-    if image is None or image.error is not None:
+  def add(self, image, rendered):
+    # rendered is what display.getRendered() returns
+    if image is None or image.error is not None or rendered is None:
       return
-    historyFile = os.path.join(syspath.HISTORYFOLDER, image.getCacheId())
-    if not self._find(historyFile):
-      shutil.copy(image.filename, historyFile)
-    h = image.copy()
-    h.setFilename(historyFile)
-    h.allowCache(False)
-
-    self._HISTORY.insert(0, h)
-    self._obeyLimits()
+    data = zlib.compress(rendered['frame'], ImageHistory.COMPRESSION)
+    with self.lock:
+      sequence = self.sequence
+      self.sequence += 1
+    entry = {
+      'sequence' : sequence,
+      'file' : '%d.frame' % sequence,
+      'id' : image.id,
+      'source' : image.source,
+      'mimetype' : image.mimetype,
+      'width' : rendered['width'],
+      'height' : rendered['height'],
+      'format' : rendered['format'],
+      'bytes' : len(data),
+      'time' : time.time()
+    }
+    filename = os.path.join(syspath.HISTORYFOLDER, entry['file'])
+    try:
+      with open(filename + '.tmp', 'wb') as f:
+        f.write(data)
+      os.rename(filename + '.tmp', filename)
+    except:
+      logging.exception('Unable to store frame in history')
+      return
+    with self.lock:
+      self._HISTORY.appendleft(entry)
+      self._obeyLimits()
+    self._STORE.markDirty()
 
   def _obeyLimits(self):
-    # Make sure history isn't too big
-    while len(self._HISTORY) > ImageHistory.MAX_HISTORY:
+    # Make sure history isn't too big, must hold the lock
+    budget = self.settings.getUser('history-size') * 1024 * 1024
+    total = sum([e['bytes'] for e in self._HISTORY])
+    while len(self._HISTORY) > 0 and (total > budget if budget > 0 else len(self._HISTORY) > ImageHistory.FRAMES):
       entry = self._HISTORY.pop()
-      if not self._find(entry.filename):
-        os.unlink(entry.filename)
+      total -= entry['bytes']
+      try:
+        os.unlink(os.path.join(syspath.HISTORYFOLDER, entry['file']))
+      except:
+        logging.exception('Failed to delete "%s"' % entry['file'])
 
   def getAvailable(self):
     return len(self._HISTORY)
 
   def getByIndex(self, index):
-    if index < 0 or index >= len(self._HISTORY):
-      logging.warning('History index requested is out of bounds (%d wanted, have 0-%d)', index, len(self._HISTORY)-1)
+    # Returns (entry, rendered) where rendered can be given to display.showFrame()
+    with self.lock:
+      if index < 0 or index >= len(self._HISTORY):
+        logging.warning('History index requested is out of bounds (%d wanted, have 0-%d)', index, len(self._HISTORY)-1)
+        return None
+      entry = dict(self._HISTORY[index])
+    try:
+      with open(os.path.join(syspath.HISTORYFOLDER, entry['file']), 'rb') as f:
+        frame = zlib.decompress(f.read())
+    except:
+      logging.exception('Unable to load frame %d from history', index)
       return None
-    entry = self._HISTORY[index]
-    # We need to make a copy which is safe to delete!
-    f = os.path.join(self.settings.get('tempfolder'), 'history')
-    shutil.copy(entry.filename, f)
-    return entry.copy().setFilename(f)
+    return entry, {'frame' : frame, 'width' : entry['width'], 'height' : entry['height'], 'format' : entry['format']}
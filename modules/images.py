@@ -14,8 +14,17 @@
 # along with photoframe.  If not, see <http://www.gnu.org/licenses/>.
 #
 import hashlib
+from array import array
+
+class ImageHolder(object):
+  # Albums can hold thousands of these, so keep them small
+  __slots__ = ['id', 'mimetype', 'error', 'source', 'url', 'filename', 'width', 'height',
+               'cacheAllow', 'cacheUsed', 'contentProvider', 'contentSource', '_cacheId']
+
+  # Strings which are the same for many items (mimetypes, providers, ...)
+  # are only stored once
+  _SHARED = {}
 
-class ImageHolder:
   def __init__(self):
     #  "id" : a unique - preferably not-changing - ID to identify the same image in future requests, e.g. hashString(imageUrl)
     #  "mimetype" : the filetype you downloaded, for example "image/jpeg"
@@ -31,31 +40,54 @@ class ImageHolder:
     self.source = None
     self.url = None
     self.filename = None
-    self.dimensions = None
+    self.width = None
+    self.height = None
     self.cacheAllow = False
     self.cacheUsed = False
 
     self.contentProvider = None
     self.contentSource = None
+    self._cacheId = None
+
+  @staticmethod
+  def share(value):
+    if value is None:
+      return None
+    return ImageHolder._SHARED.setdefault(value, value)
+
+  @property
+  def dimensions(self):
+    if self.width is None:
+      return None
+    return {'width': self.width, 'height': self.height}
+
+  @dimensions.setter
+  def dimensions(self, value):
+    if value is None:
+      self.width = self.height = None
+    else:
+      self.width = value['width']
+      self.height = value['height']
 
   def setContentProvider(self, provider):
     if provider is None:
       raise Exception('setContentProvider cannot be None')
-    self.contentProvider = repr(provider)
+    self.contentProvider = ImageHolder.share(repr(provider))
     return self
 
   def setContentSource(self, source):
     if source is None:
       raise Exception('setContentSource cannot be None')
-    self.contentSource = repr(source)
+    self.contentSource = ImageHolder.share(repr(source))
     return self
 
   def setId(self, id):
     self.id = id
+    self._cacheId = None
     return self
 
   def setMimetype(self, mimetype):
-    self.mimetype = mimetype
+    self.mimetype = ImageHolder.share(mimetype)
     return self
 
   def setError(self, error):
@@ -75,7 +107,8 @@ class ImageHolder:
     return self
 
   def setDimensions(self, width, height):
-    self.dimensions = {'width': int(width), 'height': int(height)}
+    self.width = int(width)
+    self.height = int(height)
     return self
 
   def allowCache(self, allow):
@@ -85,20 +118,93 @@ class ImageHolder:
   def getCacheId(self):
     if self.id is None:
       return None
-    return hashlib.sha1(self.id).hexdigest()
+    if self._cacheId is None:
+      self._cacheId = hashlib.sha1(self.id).hexdigest()
+    return self._cacheId
 
   def copy(self):
     copy = ImageHolder()
-    copy.id = self.id
-    copy.mimetype = self.mimetype
-    copy.error = self.error
-    copy.source = self.source
-    copy.url = self.url
-    copy.filename = self.filename
-    copy.dimensions = self.dimensions
-    copy.cacheAllow = self.cacheAllow
-    copy.cacheUsed = self.cacheUsed
-
-    copy.contentProvider = self.contentProvider
-    copy.contentSource = self.contentSource
+    for key in ImageHolder.__slots__:
+      setattr(copy, key, getattr(self, key))
     return copy
+
+class AlbumIndex(object):
+  # Holds the items of an album column by column instead of as one
+  # ImageHolder each, which is a lot less objects to create (and for the
+  # GC to walk). An ImageHolder is only made for the items actually used.
+  #
+  # Behaves like a (read-only) list of ImageHolder.
+  #
+  def __init__(self, provider=None, source=None, cacheAllow=False):
+    self.provider = None if provider is None else ImageHolder.share(repr(provider))
+    self.source = None if source is None else ImageHolder.share(repr(source))
+    self.cacheAllow = cacheAllow
+    self.ids = []
+    self.sources = []
+    self.urls = []
+    self.filenames = []
+    self.mimetypes = []
+    self.widths = array('l')
+    self.heights = array('l')
+    self.cacheIds = [] # Filled in as items are used, hashing is not free
+    self.eligible = {}
+
+  def append(self, id, source=None, mimetype=None, width=None, height=None, url=None, filename=None):
+    self.ids.append(id)
+    self.sources.append(source)
+    self.urls.append(url)
+    self.filenames.append(filename)
+    self.mimetypes.append(ImageHolder.share(mimetype))
+    # -1 means unknown, arrays can't hold None
+    self.widths.append(-1 if width is None else int(width))
+    self.heights.append(-1 if height is None else int(height))
+    self.cacheIds.append(None)
+    self.eligible = {}
+    return self
+
+  def getEligible(self, portrait, mimetypes):
+    # Positions of items with the requested orientation (None for any) and
+    # a supported mimetype. Items of unknown size or type are included.
+    # Worked out once per combination, square counts as portrait.
+    key = (portrait, tuple(sorted(mimetypes)))
+    if key not in self.eligible:
+      mimetypes = set(mimetypes)
+      result = array('l')
+      for i in range(0, len(self.ids)):
+        if self.mimetypes[i] is not None and self.mimetypes[i] not in mimetypes:
+          continue
+        if portrait is not None and self.widths[i] >= 0 and (self.widths[i] <= self.heights[i]) != portrait:
+          continue
+        result.append(i)
+      self.eligible[key] = result
+    return self.eligible[key]
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in range(*index.indices(len(self)))]
+    if index < 0:
+      index += len(self.ids)
+    item = ImageHolder()
+    item.id = self.ids[index]
+    item.source = self.sources[index]
+    item.url = self.urls[index]
+    item.filename = self.filenames[index]
+    item.mimetype = self.mimetypes[index]
+    if self.widths[index] >= 0:
+      item.width = self.widths[index]
+      item.height = self.heights[index]
+    item.cacheAllow = self.cacheAllow
+    item.contentProvider = self.provider
+    item.contentSource = self.source
+    # Holders are made on every access, keep the hash around for next time
+    if self.cacheIds[index] is None:
+      self.cacheIds[index] = item.getCacheId()
+    item._cacheId = self.cacheIds[index]
+    return item
+
+  def __iter__(self):
+    for i in range(0, len(self.ids)):
+      yield self[i]
@@ -16,23 +16,23 @@
 import os
 import json
 import logging
-import hashlib
+import threading
+
+from modules.statestore import StateStore
+from modules.helper import helper
 
 class MemoryManager:
   def __init__(self, memoryLocation):
+    # Services may be refreshed from other threads, so guard everything
+    self._LOCK = threading.RLock()
     self._MEMORY = []
+    self._MEMORY_SET = set() # Same as _MEMORY, for lookups
     self._MEMORY_KEY = None
     self._DIR_MEMORY = memoryLocation
     self._MEMORY_COUNT = {}
 
   def _hashString(self, text):
-    if type(text) is not unicode:
-      # make sure it's unicode
-      a = text.decode('ascii', errors='replace')
-    else:
-      a = text
-    a = a.encode('utf-8', errors='replace')
-    return hashlib.sha1(a).hexdigest()
+    return helper.hashString(text)
 
   def _fetch(self, key):
     if key is None:
@@ -42,8 +42,7 @@ class MemoryManager:
       return
     # Save work and swap
     if self._MEMORY is not None and len(self._MEMORY) > 0:
-      with open(os.path.join(self._DIR_MEMORY, '%s.json' % self._MEMORY_KEY), 'w') as f:
-        json.dump(self._MEMORY, f)
+      StateStore.writeAtomic(os.path.join(self._DIR_MEMORY, '%s.json' % self._MEMORY_KEY), self._MEMORY)
     if os.path.exists(os.path.join(self._DIR_MEMORY, '%s.json' % h)):
       try:
         with open(os.path.join(self._DIR_MEMORY, '%s.json' % h), 'r') as f:
@@ -54,50 +53,83 @@ class MemoryManager:
     else:
       logging.debug('_fetch returned no memory')
       self._MEMORY = []
+    self._MEMORY_SET = set(self._MEMORY)
     self._MEMORY_COUNT[h] = len(self._MEMORY)
     self._MEMORY_KEY = h
 
   def remember(self, itemId, keywords, alwaysRemember=True):
-    # The MEMORY makes sure that this image won't be shown again until memoryForget is called
-    self._fetch(keywords)
-    h = self._hashString(itemId)
-    if h not in self._MEMORY:
-      self._MEMORY.append(h)
-      k = self._hashString(keywords)
-      if k in self._MEMORY_COUNT:
-        self._MEMORY_COUNT[k] += 1
-      else:
-        self._MEMORY_COUNT[k] = 1
+    with self._LOCK:
+      # The MEMORY makes sure that this image won't be shown again until memoryForget is called
+      self._fetch(keywords)
+      h = self._hashString(itemId)
+      if h not in self._MEMORY_SET:
+        self._MEMORY.append(h)
+        self._MEMORY_SET.add(h)
+        k = self._MEMORY_KEY
+        if k in self._MEMORY_COUNT:
+          self._MEMORY_COUNT[k] += 1
+        else:
+          self._MEMORY_COUNT[k] = 1
 
-    # save memory
-    if (len(self._MEMORY) % 20) == 0:
-      logging.info('Interim saving of memory every 20 entries')
-      with open(os.path.join(self._DIR_MEMORY, '%s.json' % self._MEMORY_KEY), 'w') as f:
-        json.dump(self._MEMORY, f)
+      # save memory
+      if (len(self._MEMORY) % 20) == 0:
+        logging.info('Interim saving of memory every 20 entries')
+        StateStore.writeAtomic(os.path.join(self._DIR_MEMORY, '%s.json' % self._MEMORY_KEY), self._MEMORY)
 
   def getList(self, keywords):
-    self._fetch(keywords)
-    return self._MEMORY
+    with self._LOCK:
+      self._fetch(keywords)
+      return self._MEMORY
 
   def count(self, keywords):
-    if self._MEMORY_KEY is None:
-      self._fetch(keywords)
-    h = self._hashString(keywords)
-    if h in self._MEMORY_COUNT:
+    # Counts are kept up to date by remember/forget/prune, so this only
+    # needs to read a file the first time it's asked about a keyword
+    with self._LOCK:
+      if self._MEMORY_KEY is None:
+        self._fetch(keywords)
+      h = self._hashString(keywords)
+      if h not in self._MEMORY_COUNT:
+        self._MEMORY_COUNT[h] = self._countFile(h)
       return self._MEMORY_COUNT[h]
-    return 0
+
+  def _countFile(self, h):
+    filename = os.path.join(self._DIR_MEMORY, '%s.json' % h)
+    if not os.path.exists(filename):
+      return 0
+    try:
+      with open(filename, 'r') as f:
+        return len(json.load(f))
+    except:
+      logging.exception('File %s is corrupt' % filename)
+      return 0
 
   def seen(self, itemId, keywords):
-    self._fetch(keywords)
-    h = self._hashString(itemId)
-    return h in self._MEMORY
+    with self._LOCK:
+      self._fetch(keywords)
+      return self._hashString(itemId) in self._MEMORY_SET
 
   def forget(self, keywords):
-    self._fetch(keywords)
-    n = os.path.join(self._DIR_MEMORY, '%s.json' % self._MEMORY_KEY)
-    if os.path.exists(n):
-      logging.debug('Removed memory file %s' % n)
-      os.unlink(n)
-    logging.debug('Has %d memories before wipe' % len(self._MEMORY))
-    self._MEMORY = []
-    self._MEMORY_COUNT.pop(self._hashString(keywords), None)
+    with self._LOCK:
+      self._fetch(keywords)
+      n = os.path.join(self._DIR_MEMORY, '%s.json' % self._MEMORY_KEY)
+      if os.path.exists(n):
+        logging.debug('Removed memory file %s' % n)
+        os.unlink(n)
+      logging.debug('Has %d memories before wipe' % len(self._MEMORY))
+      self._MEMORY = []
+      self._MEMORY_SET = set()
+      self._MEMORY_COUNT.pop(self._MEMORY_KEY, None)
+
+  def prune(self, keywords, itemIds):
+    # Drops memories of items which no longer exist
+    with self._LOCK:
+      self._fetch(keywords)
+      valid = set([self._hashString(i) for i in itemIds])
+      before = len(self._MEMORY)
+      self._MEMORY = [h for h in self._MEMORY if h in valid]
+      self._MEMORY_SET = set(self._MEMORY)
+      if before == len(self._MEMORY):
+        return
+      logging.debug('Pruned %d memories which no longer exist', before - len(self._MEMORY))
+      self._MEMORY_COUNT[self._MEMORY_KEY] = len(self._MEMORY)
+      StateStore.writeAtomic(os.path.join(self._DIR_MEMORY, '%s.json' % self._MEMORY_KEY), self._MEMORY)
@@ -23,6 +23,7 @@ class path:
   OPTIONSFILE   = '/root/photoframe_config/options'
   CACHEFOLDER   = '/root/cache/'
   HISTORYFOLDER = '/root/history/'
+  BOOTFRAME     = '/root/photoframe_config/bootframe'
 
   DRV_BUILTIN   = '/root/photoframe/display-drivers'
   DRV_EXTERNAL  = '/root/photoframe_config/display-drivers/'
@@ -41,6 +42,7 @@ class path:
     path.DRV_EXTERNAL   = path.DRV_EXTERNAL.replace('/root/', newbase)
     path.CACHEFOLDER    = path.CACHEFOLDER.replace('/root/', newbase)
     path.HISTORYFOLDER  = path.HISTORYFOLDER.replace('/root/', newbase)
+    path.BOOTFRAME      = path.BOOTFRAME.replace('/root/', newbase)
 
   def validate(self):
     # Supercritical, since we store all photoframe files in a subdirectory, make sure to create it
@@ -0,0 +1,111 @@
+# This file is part of photoframe (https://github.com/mrworf/photoframe).
+#
+# photoframe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# photoframe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with photoframe.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import threading
+import itertools
+import multiprocessing
+import Queue
+
+# Shared pool of workers for the heavy lifting (rotate, frame, colormatch,
+# framebuffer conversion). Almost all of the actual work is done by
+# ImageMagick & friends in child processes, so plain threads are enough
+# to keep all cores of a Pi 3/4 busy.
+#
+# Jobs are picked in priority order, so the web UI never has to wait behind
+# a queue of prefetched images.
+#
+class ImageProcessor:
+  PRIORITY_UI = 0
+  PRIORITY_SHOW = 1
+  PRIORITY_PREFETCH = 2
+
+  class Job:
+    def __init__(self, name, func, args, kwargs):
+      self.name = name
+      self.func = func
+      self.args = args
+      self.kwargs = kwargs
+      self.result = None
+      self.failed = False
+      self.started = False
+      self.cancelled = False
+      self.lock = threading.Lock()
+      self.done = threading.Event()
+
+    def _begin(self):
+      with self.lock:
+        if self.cancelled:
+          return False
+        self.started = True
+        return True
+
+    def cancel(self):
+      # Returns True if the job never ran, otherwise it will complete as usual
+      with self.lock:
+        if self.started:
+          return False
+        self.cancelled = True
+      self.done.set()
+      return True
+
+    def isDone(self):
+      return self.done.is_set()
+
+    def wait(self, timeout=None):
+      self.done.wait(timeout)
+      return self.result
+
+  def __init__(self, workers=None):
+    if workers is None:
+      try:
+        workers = multiprocessing.cpu_count()
+      except NotImplementedError:
+        workers = 1
+    self.workers = max(1, workers)
+    self.queue = Queue.PriorityQueue()
+    self.sequence = itertools.count()
+
+    for i in range(0, self.workers):
+      t = threading.Thread(target=self._worker, name='ImageProcessor-%d' % i)
+      t.daemon = True
+      t.start()
+    logging.info('Image processing will use %d workers', self.workers)
+
+  def submit(self, priority, name, func, *args, **kwargs):
+    job = ImageProcessor.Job(name, func, args, kwargs)
+    # Sequence keeps jobs with the same priority in FIFO order
+    self.queue.put((priority, next(self.sequence), job))
+    return job
+
+  def run(self, priority, name, func, *args, **kwargs):
+    # Convenience for callers which need the result right away
+    return self.submit(priority, name, func, *args, **kwargs).wait()
+
+  def pending(self):
+    return self.queue.qsize()
+
+  def _worker(self):
+    while True:
+      _, _, job = self.queue.get()
+      if not job._begin():
+        logging.debug('Job "%s" was cancelled before it started', job.name)
+        continue
+      try:
+        job.result = job.func(*job.args, **job.kwargs)
+      except:
+        logging.exception('Job "%s" failed', job.name)
+        job.failed = True
+      job.done.set()
@@ -0,0 +1,114 @@
+# This file is part of photoframe (https://github.com/mrworf/photoframe).
+#
+# photoframe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# photoframe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with photoframe.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import threading
+import time
+
+# Refreshes keyword listings (albums) out-of-band from the slideshow.
+#
+# Services keep using their old listing until the new one is complete,
+# at which point the service swaps it in. Each service decides how many
+# of its keywords may be refreshed at the same time (REFRESH_CONCURRENCY)
+# so we don't get throttled by any single provider. Workers only pick
+# jobs for services which are below their limit, and sleep until a job
+# is added or finished when there is nothing they can pick.
+#
+class KeywordRefresher:
+  def __init__(self, workers=4):
+    self.lock = threading.Lock()
+    self.changed = threading.Condition(self.lock)
+    self.jobs = []
+    self.pending = {}
+    self.running = {}
+    self.listener = None
+    self.refreshed = {}
+
+    for i in range(0, workers):
+      t = threading.Thread(target=self._worker, name='KeywordRefresher-%d' % i)
+      t.daemon = True
+      t.start()
+
+  def setListener(self, listener):
+    # Called with the service after each refresh, from the worker thread
+    self.listener = listener
+
+  def _key(self, svc, keyword):
+    return (svc.getId(), keyword)
+
+  def schedule(self, svc, keyword):
+    # Returns False if the keyword is already queued or being refreshed
+    key = self._key(svc, keyword)
+    with self.lock:
+      if key in self.pending:
+        return False
+      self.pending[key] = threading.Event()
+      self.jobs.append((svc, keyword))
+      self.changed.notify()
+    return True
+
+  def isPending(self, svc, keyword):
+    with self.lock:
+      return self._key(svc, keyword) in self.pending
+
+  def age(self, svc, keyword):
+    # Seconds since keyword was last refreshed, None if it hasn't been
+    with self.lock:
+      when = self.refreshed.get(self._key(svc, keyword), None)
+    if when is None:
+      return None
+    return time.time() - when
+
+  def wait(self, svc, keyword, timeout=None):
+    with self.lock:
+      done = self.pending.get(self._key(svc, keyword), None)
+    if done is not None:
+      done.wait(timeout)
+
+  def _nextJob(self):
+    # Oldest job for a service which isn't busy, must hold the lock
+    for i, (svc, keyword) in enumerate(self.jobs):
+      if self.running.get(svc.getId(), 0) < max(1, svc.REFRESH_CONCURRENCY):
+        self.running[svc.getId()] = self.running.get(svc.getId(), 0) + 1
+        return self.jobs.pop(i)
+    return None
+
+  def _worker(self):
+    while True:
+      with self.changed:
+        job = self._nextJob()
+        while job is None:
+          self.changed.wait()
+          job = self._nextJob()
+      svc, keyword = job
+      key = self._key(svc, keyword)
+      start = time.time()
+      try:
+        svc._refreshImagesFor(keyword)
+        with self.lock:
+          self.refreshed[key] = time.time()
+        logging.debug('Refreshed "%s" for %s in %.1fs', keyword, svc.getName(), time.time() - start)
+      except:
+        logging.exception('Failed to refresh "%s" for %s', keyword, svc.getName())
+      finally:
+        with self.changed:
+          self.running[svc.getId()] -= 1
+          done = self.pending.pop(key, None)
+          # Jobs for this service may be waiting on us
+          self.changed.notifyAll()
+        if done is not None:
+          done.set()
+      if self.listener is not None:
+        self.listener(svc)
@@ -16,8 +16,10 @@
 import logging
 import os
 import re
+import time
 import traceback
 import importlib
+import Queue
 
 from threading import Thread
 
@@ -26,6 +28,7 @@ from modules.sysconfig import sysconfig
 from flask import Flask, request
 from flask_httpauth import HTTPBasicAuth
 from werkzeug.exceptions import HTTPException
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 
 # used if we don't find authentication json
 class NoAuth:
@@ -38,15 +41,71 @@ class NoAuth:
     wrap.func_name = fn.func_name
     return wrap
 
+# Times every request from the request line until the response is sent
+class TimedRequestHandler(WSGIRequestHandler):
+  SLOW_REQUEST = 1.0 # Seconds before a request is logged as a warning
+  STREAMS = ['/events/stream'] # Long lived by design, never slow
+
+  def handle_one_request(self):
+    self.statusCode = '-'
+    start = time.time()
+    WSGIRequestHandler.handle_one_request(self)
+    if not self.raw_requestline or not hasattr(self, 'command'):
+      return
+    spent = time.time() - start
+    if spent >= TimedRequestHandler.SLOW_REQUEST and self.path.split('?')[0] not in TimedRequestHandler.STREAMS:
+      logging.warning('Slow request: %s %s -> %s took %.0fms', self.command, self.path, self.statusCode, spent * 1000)
+    else:
+      logging.debug('Request: %s %s -> %s took %.0fms', self.command, self.path, self.statusCode, spent * 1000)
+
+  def log_request(self, code='-', size='-'):
+    # Replaces werkzeug's access log, see handle_one_request()
+    self.statusCode = code
+
+# Accepts connections on one thread and hands them to a fixed set of
+# workers, so a slow request (framebuffer dump, hardware details) doesn't
+# hold up everything else. When all workers are busy and QUEUE_SIZE
+# connections are waiting, we stop accepting until there's room.
+class PooledWSGIServer(BaseWSGIServer):
+  QUEUE_SIZE = 32
+
+  def __init__(self, host, port, app, workers):
+    BaseWSGIServer.__init__(self, host, port, app, handler=TimedRequestHandler)
+    self.pending = Queue.Queue(PooledWSGIServer.QUEUE_SIZE)
+    for i in range(0, workers):
+      t = Thread(target=self._worker, name='WebWorker-%d' % i)
+      t.daemon = True
+      t.start()
+
+  def process_request(self, request, client_address):
+    self.pending.put((request, client_address))
+
+  def _worker(self):
+    while True:
+      request, client_address = self.pending.get()
+      try:
+        self.finish_request(request, client_address)
+      except:
+        try:
+          self.handle_error(request, client_address)
+        except:
+          logging.exception('Unable to handle request from %s', repr(client_address))
+      finally:
+        self.shutdown_request(request)
+
 class WebServer(Thread):
-  def __init__(self, async=False, port=7777, listen='0.0.0.0'):
+  WORKERS = 4
+
+  def __init__(self, async=False, port=7777, listen='0.0.0.0', workers=WORKERS):
     Thread.__init__(self)
     self.port = port
     self.listen = listen
     self.async = async
+    self.workers = workers
 
     self.app = Flask(__name__, static_url_path='/--do--not--ever--use--this--')
     self.app.config['UPLOAD_FOLDER'] = '/tmp/'
+    self.cacheable = set()
     self.user = sysconfig.getHTTPAuth()
     self.auth = NoAuth()
     if self.user is not None:
@@ -79,7 +138,7 @@ class WebServer(Thread):
 
   def start(self):
     if self.async:
-      self.start()
+      Thread.start(self)
     else:
       self.run()
 
@@ -98,7 +157,8 @@ class WebServer(Thread):
 
   def run(self):
     try:
-      self.app.run(debug=False, port=self.port, host=self.listen )
+      logging.info('Serving on %s:%d using %d workers', self.listen, self.port, self.workers)
+      PooledWSGIServer(self.listen, self.port, self.app, self.workers).serve_forever()
     except RuntimeError, msg:
       if str(msg) == "Server shutdown":
         pass # or whatever you want to do when the server goes down
@@ -106,6 +166,8 @@ class WebServer(Thread):
         raise RuntimeError(msg)
 
   def _nocache(self, r):
+      if request.endpoint in self.cacheable:
+        return r
       r.headers["Pragma"] = "no-cache"
       r.headers["Expires"] = "0"
       r.headers['Cache-Control'] = 'public, max-age=0'
@@ -148,6 +210,8 @@ class WebServer(Thread):
       else:
         logging.info('Registering URL %s to %s', mapping._URL, route.__class__.__name__)
       self.app.add_url_rule(mapping._URL, mapping._URL, route, methods=mapping._METHODS, defaults=mapping._DEFAULTS)
+      if route.CACHEABLE:
+        self.cacheable.add(mapping._URL)
 
   def _registerHandlers(self):
     for item in os.listdir('routes'):
@@ -25,16 +25,23 @@ import importlib
 
 from modules.helper import helper
 from modules.path import path
+from modules.refresher import KeywordRefresher
+from modules.dedupe import DedupeManager
 from services.base import BaseService
 
 class ServiceManager:
+  REFRESH_MINAGE = 3600 # Seconds, small albums are shown quickly and shouldn't be refreshed every round
+
   def __init__(self, settings, cacheMgr):
     self._SETTINGS = settings
     self._CACHEMGR = cacheMgr
+    self._REFRESHER = KeywordRefresher()
+    self._REFRESHER.setListener(lambda svc: self._updateServiceState(svc.getId()))
 
     svc_folder = os.path.join(path.CONFIGFOLDER, 'services')
     if not os.path.exists(svc_folder):
       os.mkdir(svc_folder)
+    self._DEDUPEMGR = DedupeManager(svc_folder)
 
     self._BASEDIR = svc_folder
     self._SVC_INDEX = {} # Holds all detected services
@@ -52,6 +59,10 @@ class ServiceManager:
     # Tracks current service showing the image
     self.currentService = None
 
+    # Last known state of each service, changes are published as events
+    self._EVENTMGR = None
+    self._LAST_STATE = {}
+
     # Track configuration changes
     self.configChanges = 0
 
@@ -129,6 +140,8 @@ class ServiceManager:
       if klass:
         svc = eval("klass(self._BASEDIR, entry['id'], entry['name'])")
         svc.setCacheManager(self._CACHEMGR)
+        svc.setRefresher(self._REFRESHER)
+        svc.setDedupeManager(self._DEDUPEMGR)
         self._SERVICES[svc.getId()] = {'service' : svc, 'id' : svc.getId(), 'name' : svc.getName()}
 
   def _hash(self, text):
@@ -137,6 +150,22 @@ class ServiceManager:
   def _configChanged(self):
     self.configChanges += 1
 
+  def setEventManager(self, eventMgr):
+    self._EVENTMGR = eventMgr
+    for id in self._SERVICES:
+      self._updateServiceState(id)
+
+  def _publishState(self, id, state):
+    if self._EVENTMGR is None or self._LAST_STATE.get(id, None) == state:
+      return
+    self._LAST_STATE[id] = state
+    self._EVENTMGR.publish('service', {'id' : id, 'name' : self._SERVICES[id]['service'].getName(), 'state' : state}, key=id)
+
+  def _updateServiceState(self, id):
+    # Call whenever something which may change the state of a service has happened
+    if id in self._SERVICES:
+      self.getServiceStateText(id)
+
   def getConfigChange(self):
     return self.configChanges
 
@@ -150,9 +179,12 @@ class ServiceManager:
     if klass:
       svc = eval("klass(self._BASEDIR, genid, name)")
       svc.setCacheManager(self._CACHEMGR)
+      svc.setRefresher(self._REFRESHER)
+      svc.setDedupeManager(self._DEDUPEMGR)
       self._SERVICES[genid] = {'service' : svc, 'id' : svc.getId(), 'name' : svc.getName()}
       self._save()
       self._configChanged()
+      self._updateServiceState(genid)
       return genid
     return None
 
@@ -168,7 +200,10 @@ class ServiceManager:
     if id not in self._SERVICES:
       return
 
+    self._publishState(id, 'DELETED')
+    self._LAST_STATE.pop(id, None)
     self._HISTORY = filter(lambda h: h != self._SERVICES[id]['service'], self._HISTORY)
+    self._SERVICES[id]['service'].releaseState()
     del self._SERVICES[id]
     self._deletefolder(os.path.join(self._BASEDIR, id))
     self._configChanged()
@@ -184,13 +219,16 @@ class ServiceManager:
       return False
     svc = self._SERVICES[state[2]]['service']
     svc.finishOAuth(request.url)
+    self._updateServiceState(state[2])
     return True
 
   def oauthConfig(self, service, data):
     if service not in self._SERVICES:
       return False
     svc = self._SERVICES[service]['service']
-    return svc.setOAuthConfig(data)
+    result = svc.setOAuthConfig(data)
+    self._updateServiceState(service)
+    return result
 
   def oauthStart(self, service):
     if service not in self._SERVICES:
@@ -223,6 +261,7 @@ class ServiceManager:
     if not svc.validateConfiguration(config):
       return False
     svc.setConfiguration(config)
+    self._updateServiceState(service)
     return True
 
   def getServiceKeywords(self, service):
@@ -242,7 +281,9 @@ class ServiceManager:
     if svc in self._OUT_OF_IMAGES:
       self._OUT_OF_IMAGES.remove(svc)
     self._configChanged()
-    return svc.addKeywords(keywords)
+    result = svc.addKeywords(keywords)
+    self._updateServiceState(service)
+    return result
 
   def removeServiceKeywords(self, service, index):
     if service not in self._SERVICES:
@@ -253,7 +294,9 @@ class ServiceManager:
       logging.error('removeServiceKeywords: Does not use keywords')
       return False
     self._configChanged()
-    return svc.removeKeywords(index)
+    result = svc.removeKeywords(index)
+    self._updateServiceState(service)
+    return result
 
   def sourceServiceKeywords(self, service, index):
     if service not in self._SERVICES:
@@ -273,6 +316,14 @@ class ServiceManager:
       return None
     return svc.getKeywordDetails(index)
 
+  def suggestServiceKeywords(self, service, text):
+    if service not in self._SERVICES:
+      return []
+    svc = self._SERVICES[service]['service']
+    if not svc.hasKeywordSuggestions():
+      return []
+    return svc.getKeywordSuggestions(text)
+
   def helpServiceKeywords(self, service):
     if service not in self._SERVICES:
       return False
@@ -291,16 +342,20 @@ class ServiceManager:
   def getServiceStateText(self, id):
     state = self.getServiceState(id)
     if state == BaseService.STATE_DO_OAUTH:
-      return 'OAUTH'
+      text = 'OAUTH'
     elif state == BaseService.STATE_DO_CONFIG:
-      return 'CONFIG'
+      text = 'CONFIG'
     elif state == BaseService.STATE_NEED_KEYWORDS:
-      return 'NEED_KEYWORDS'
+      text = 'NEED_KEYWORDS'
     elif state == BaseService.STATE_NO_IMAGES:
-      return 'NO_IMAGES'
+      text = 'NO_IMAGES'
     elif state == BaseService.STATE_READY:
-      return 'READY'
-    return 'ERROR'
+      text = 'READY'
+    else:
+      text = 'ERROR'
+    if state is not None:
+      self._publishState(id, text)
+    return text
 
   def getAllServiceStates(self):
     serviceStates = []
@@ -348,6 +403,10 @@ class ServiceManager:
 
   def getServices(self, readyOnly=False):
     result = []
+    if readyOnly:
+      # Get all services indexing at the same time instead of one by one
+      for k in self._SERVICES:
+        self._SERVICES[k]['service'].scheduleRefresh()
     for k in self._SERVICES:
       if readyOnly and self.getServiceState(k) != BaseService.STATE_READY:
         continue
@@ -360,6 +419,7 @@ class ServiceManager:
         'useKeywords' : svc['service'].needKeywords(),
         'hasSourceUrl' : svc['service'].hasKeywordSourceUrl(),
         'hasDetails' : svc['service'].hasKeywordDetails(),
+        'hasSuggestions' : svc['service'].hasKeywordSuggestions(),
         'messages' : svc['service'].getMessages(),
       })
     return result
@@ -424,8 +484,9 @@ class ServiceManager:
       for k in svc.getKeywords():
         if svc.freshnessImagesFor(k) < maxage:
           continue
-        logging.info('Expire is set to %dh, expiring %s which was %d hours old', maxage, k, svc.freshnessImagesFor(k))
-        svc._clearImagesFor(k)
+        # Old index stays in use until the refreshed one is ready
+        if self._REFRESHER.schedule(svc, k):
+          logging.info('Expire is set to %dh, refreshing %s which was %d hours old', maxage, k, svc.freshnessImagesFor(k))
 
   def getTotalImageCount(self):
     services = self.getServices(readyOnly=True)
@@ -440,6 +501,7 @@ class ServiceManager:
     if svc is None:
       return None
     result = svc.prepareNextItem(destinationDir, supportedMimeTypes, displaySize, randomize)
+    self._updateServiceState(svc.getId())
     if result is None:
       logging.warning('prepareNextItem for %s came back with None', svc.getName())
     elif result.error is not None:
@@ -463,13 +525,29 @@ class ServiceManager:
       return True
     return False
 
+  def markShown(self, image):
+    # Photos looking like this one are skipped for the rest of the round
+    self._DEDUPEMGR.markShown(image.getCacheId())
+
   def memoryForgetAll(self):
+    # Starts a new round where all images will be shown again. The index is
+    # kept, refreshing it is up to the refresh policy (see
+    # expireStaleKeywords) which does it in the background.
     logging.info("Photoframe's memory was reset. Already displayed images will be shown again!")
+    refreshNow = self._SETTINGS.getUser('refresh') == 0
+    self._DEDUPEMGR.reset()
     for key in self._SERVICES:
       svc = self._SERVICES[key]["service"]
       for k in svc.getKeywords():
-        logging.info('%s was %d hours old when we refreshed' % (k, svc.freshnessImagesFor(k)))
-        svc._clearImagesFor(k)
+        svc._resetMemoryFor(k)
+        if refreshNow:
+          # Refresh of zero means "when all is shown", so that's now unless
+          # we just did it
+          age = self._REFRESHER.age(svc, k)
+          if age is None or age >= ServiceManager.REFRESH_MINAGE:
+            self._REFRESHER.schedule(svc, k)
+          else:
+            logging.debug('Not refreshing %s, it was refreshed %d minutes ago', k, age / 60)
 
   def nextAlbum(self):
     return False
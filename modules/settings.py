@@ -18,6 +18,7 @@ import json
 import logging
 import random
 from path import path
+from statestore import StateStore
 
 class settings:
   DEPRECATED_USER = ['resolution']
@@ -32,6 +33,7 @@ class settings:
       'cfg' : None
     }
     self.userDefaults()
+    self.store = StateStore(path.CONFIGFILE, lambda: self.settings)
 
   def userDefaults(self):
     self.settings['cfg'] = {
@@ -55,6 +57,9 @@ class settings:
       'randomize_images' : 1,
       'enable-cache' : 1,
       'offline-behavior' : 'wait', # wait = wait for network, ignore = try next (rely on cache or non-internet connections)
+      'transition' : 'none',	# none, crossfade or wipe between images
+      'transition-time' : 1.0,	# Seconds a transition takes
+      'history-size' : 0,			# Megabytes of (compressed) frames kept for going back, 0 keeps the last 20
     }
 
   def load(self):
@@ -100,9 +105,9 @@ class settings:
     else:
       return False
 
-  def save(self):
-    with open(path.CONFIGFILE, 'w') as f:
-      json.dump(self.settings, f)
+  def save(self, immediate=False):
+    # Writes are coalesced and atomic, see StateStore
+    self.store.markDirty(immediate)
 
   def convertToNative(self, value):
     try:
@@ -20,6 +20,8 @@ import os
 import socket
 import logging
 
+from modules.statestore import StateStore
+
 class shutdown(Thread):
 	def __init__(self, usePIN=26):
 		Thread.__init__(self)
@@ -59,6 +61,7 @@ class shutdown(Thread):
 			i = poller.poll(None)
 			for (fd, event) in i:
 				if f.fileno() == fd:
+					StateStore.flushAll()
 					subprocess.call(['/sbin/poweroff'], stderr=self.void);
 					logging.debug('Shutdown GPIO triggered')
 				elif self.server.fileno() == fd:
@@ -20,12 +20,15 @@ import time
 
 from modules.helper import helper
 from modules.network import RequestNoNetwork
+from modules.processor import ImageProcessor
+from modules.images import ImageHolder
 
 class slideshow:
   SHOWN_IP = False
+  PREFETCH_DEPTH = 2 # Number of images downloaded and processed ahead of time
   EVENTS = ["nextImage", "prevImage", "nextAlbum", "prevAlbum", "settingsChange", "memoryForget", "clearCache", "forgetPreload"]
 
-  def __init__(self, display, settings, colormatch, history):
+  def __init__(self, display, settings, colormatch, history, processor):
     self.countdown = 0
     self.thread = None
     self.services = None
@@ -33,7 +36,9 @@ class slideshow:
     self.settings = settings
     self.colormatch = colormatch
     self.history = history
+    self.processor = processor
     self.cacheMgr = None
+    self.eventMgr = None
     self.void = open(os.devnull, 'wb')
     self.delayer = threading.Event()
     self.cbStopped = None
@@ -43,7 +48,11 @@ class slideshow:
     self.imageCurrent = None
     self.skipPreloadedImage = False
 
-    self.historyIndex = -1
+    # Holds (image, job) tuples for upcoming images, job is None for errors
+    self.prefetched = []
+
+    self.historyIndex = -1 # -1 is live, otherwise what we show from history
+    self.historyJob = None
     self.minimumWait = 1
 
     self.supportedFormats = helper.getSupportedTypes()
@@ -68,6 +77,9 @@ class slideshow:
   def setServiceManager(self, services):
     self.services = services
 
+  def setEventManager(self, eventMgr):
+    self.eventMgr = eventMgr
+
   def setCacheManager(self, cacheMgr):
     self.cacheMgr = cacheMgr
 
@@ -125,16 +137,17 @@ class slideshow:
           self.cacheMgr.empty()
         if self.imageCurrent:
           self.imageCurrent = None
+          self.historyIndex = -1
           self.display.clear()
           showNext = False
       elif event == "nextImage":
         logging.info('nextImage called, historyIndex is %d', self.historyIndex)
+        if self.historyIndex >= 0:
+          showNext = not self.showHistory(self.historyIndex - 1)
       elif event == "prevImage":
-        if self.historyIndex == -1:
-          # special case, first time, history holds what we're showing, so step twice
-          self.historyIndex = min(self.history.getAvailable()-1, self.historyIndex+2)
-        else:
-          self.historyIndex = min(self.history.getAvailable()-1, self.historyIndex+1)
+        # History starts with what we're showing
+        index = self.historyIndex + 1 if self.historyIndex >= 0 else 1
+        self.showHistory(min(self.history.getAvailable()-1, index))
         logging.info('prevImage called, historyIndex is %d', self.historyIndex)
         showNext = False
       elif event == "nextAlbum":
@@ -147,12 +160,17 @@ class slideshow:
         self.skipPreloadedImage = True
         self.services.prevAlbum()
         self.delayer.set()
-      elif event == 'forgetPreload':
+      elif event == 'forgetPreload' or event == 'settingsChange':
+        # Prepared images were made using the old settings
         self.skipPreloadedImage = True
     return showNext
 
   def startupScreen(self):
     slideshow.SHOWN_IP = True
+    if self.display.hasBootFrame():
+      # Already showing what we had before, better than a countdown
+      logging.info('Skipping countdown, last frame is on screen')
+      return
     # Once we have IP, show for 10s
     cd = self.countdown
     while (cd > 0):
@@ -205,7 +223,12 @@ class slideshow:
     return False
 
   def _colormatch(self, filenameProcessed):
+    if self.colormatch.canTint():
+      # Display applies it to the final frame, much cheaper
+      return filenameProcessed
     if self.colormatch.hasSensor():
+      # The script doesn't know about EXIF orientation
+      filenameProcessed = helper.autoRotate(filenameProcessed)
       # For Now: Always process original image (no caching of colormatch-adjusted images)
       # 'colormatched_tmp.jpg' will be deleted after the image is displayed
       p, f = os.path.split(filenameProcessed)
@@ -217,15 +240,37 @@ class slideshow:
     return filenameProcessed
 
   def remember(self, image):
+    # Compressing the frame takes a moment, don't hold up the slideshow
     logging.debug('Commit this to history')
-    self.history.add(image)
+    if not self.display.isEnabled():
+      return
+    self.historyJob = self.processor.submit(ImageProcessor.PRIORITY_PREFETCH, 'history %s' % image.id, self.history.add, image, self.display.getRendered())
+
+  def showHistory(self, index):
+    # Puts a frame from history on screen right away, returns False (and
+    # goes live) if there's nothing to show
+    if self.historyJob is not None:
+      self.historyJob.wait()
+      self.historyJob = None
+    item = None
+    if index >= 0:
+      item = self.history.getByIndex(index)
+    if item is None or not self.display.showFrame(item[1], self.settings.getUser('transition'), self.settings.getUser('transition-time')):
+      self.historyIndex = -1
+      return False
+    entry = item[0]
+    self.historyIndex = index
+    self.imageCurrent = ImageHolder().setId(entry['id']).setSource(entry['source']).setMimetype(entry['mimetype'])
+    if self.eventMgr is not None:
+      self.eventMgr.publish('slide', {'id' : entry['id'], 'source' : entry['source'], 'history' : self.historyIndex})
+    return True
 
   def process(self, image):
     logging.debug('Processing %s', image.id)
     imageSizing = self.settings.getUser('imagesizing')
 
-    # Make sure it's oriented correctly
-    filename = helper.autoRotate(image.filename)
+    # Orientation is handled by -auto-orient when we frame/display it
+    filename = image.filename
 
     # At this point, we have a good image, store it if allowed
     if image.cacheAllow and not image.cacheUsed:
@@ -261,8 +306,53 @@ class slideshow:
       logging.warning("Trying to show image '%s', but file does not exist!" % image.filename)
       self.delayer.set()
       return
-    self.display.image(image.filename)
+    self.display.image(image.filename, self.settings.getUser('transition'), self.settings.getUser('transition-time'))
     self.imageCurrent = image
+    self.services.markShown(image)
+    self.remember(image)
+    if self.eventMgr is not None:
+      self.eventMgr.publish('slide', {'id' : image.id, 'source' : image.source, 'history' : self.historyIndex})
+
+  def prefetch(self, displaySize, randomize):
+    # Keep a few images downloaded and queued for processing, that way the
+    # processing of one image runs in parallel with the download of the next
+    while self.running and len(self.prefetched) < slideshow.PREFETCH_DEPTH:
+      if len(self.prefetched) > 0 and self.prefetched[-1][1] is None:
+        # Errors must be shown before we continue
+        break
+      try:
+        result = self.services.servicePrepareNextItem(self.settings.get('tempfolder'), self.supportedFormats, displaySize, randomize)
+      except RequestNoNetwork:
+        if len(self.prefetched) == 0:
+          raise
+        logging.warning('Network went away while prefetching, will use what we have')
+        break
+      if result is None or result.error is not None:
+        self.prefetched.append((result, None))
+        break
+
+      priority = ImageProcessor.PRIORITY_PREFETCH
+      if len(self.prefetched) == 0:
+        priority = ImageProcessor.PRIORITY_SHOW
+      job = self.processor.submit(priority, 'process %s' % result.id, self.process, result)
+      self.prefetched.append((result, job))
+
+  def flushPrefetch(self):
+    # Anything prepared ahead of time no longer reflects what should be shown
+    while len(self.prefetched) > 0:
+      image, job = self.prefetched.pop(0)
+      if job is None:
+        continue
+      if job.cancel():
+        filename = image.filename
+      else:
+        filename = job.wait()
+        if filename is None:
+          # Processing failed, the download is still around
+          filename = image.filename
+      if filename is not None and os.path.exists(filename):
+        logging.debug('Deleting prefetched file "%s"' % filename)
+        os.unlink(filename)
 
   def presentation(self):
     self.services.getServices(readyOnly=True)
@@ -278,6 +368,7 @@ class slideshow:
     i = 0
     result = None
     lastCfg = self.services.getConfigChange()
+    held = None # Prepared while we were showing history
     while self.running:
       i += 1
       time_process = time.time()
@@ -288,33 +379,45 @@ class slideshow:
       displaySize = {'width': self.settings.getUser('width'), 'height': self.settings.getUser('height'), 'force_orientation': self.settings.getUser('force_orientation')}
       randomize = self.settings.getUser('randomize_images')
 
-      try:
-        if self.historyIndex == -1:
-          result = self.services.servicePrepareNextItem(self.settings.get('tempfolder'), self.supportedFormats, displaySize, randomize)
-          self.remember(result)
-        else:
-          logging.info('Fetching history image %d of %d', self.historyIndex, self.history.getAvailable())
-          result = self.history.getByIndex(self.historyIndex)
-          self.historyIndex = max(-1, self.historyIndex-1)
-      except RequestNoNetwork:
-        offline = self.settings.getUser('offline-behavior')
-        if offline == 'wait':
-          self.waitForNetwork()
-          continue
-        elif offline == 'ignore':
-          pass
-
-      if not self.handleErrors(result):
-        filenameProcessed = self.process(result)
-        result = result.copy().setFilename(filenameProcessed)
+      job = None
+      if held is not None or self.historyIndex >= 0:
+        # Showing history, what we have is shown once we're back
+        result = held
+        held = None
       else:
-        result = None
+        try:
+          self.prefetch(displaySize, randomize)
+          result, job = self.prefetched.pop(0)
+        except RequestNoNetwork:
+          offline = self.settings.getUser('offline-behavior')
+          if offline == 'wait':
+            self.waitForNetwork()
+            continue
+          elif offline == 'ignore':
+            pass
+
+        if not self.handleErrors(result):
+          if job is None:
+            job = self.processor.submit(ImageProcessor.PRIORITY_SHOW, 'process %s' % result.id, self.process, result)
+          filenameProcessed = job.wait()
+          if filenameProcessed is None:
+            logging.error('Processing of %s failed, skipping it', result.id)
+            if result.filename is not None and os.path.exists(result.filename):
+              os.unlink(result.filename)
+            result = None
+          else:
+            result = result.copy().setFilename(filenameProcessed)
+        else:
+          result = None
 
       time_process = time.time() - time_process
       logging.debug('Took %f seconds to process, next image is %s', time_process, result.filename if result is not None else "None")
       self.delayNextImage(time_process)
 
       showNextImage = self.handleEvents()
+      if showNextImage and self.historyIndex >= 0:
+        # Time is up while showing history, move forward
+        showNextImage = not self.showHistory(self.historyIndex - 1)
 
       # Handle changes to config to avoid showing an image which is unexpected
       if self.services.getConfigChange() != lastCfg:
@@ -322,16 +425,26 @@ class slideshow:
         self.skipPreloadedImage = True
         lastCfg = self.services.getConfigChange()
 
+      if self.skipPreloadedImage:
+        self.flushPrefetch()
+
       if self.running and result is not None:
         # Skip this section if we were killed while waiting around
         if showNextImage and not self.skipPreloadedImage:
           self.showPreloadedImage(result)
+        elif self.historyIndex >= 0 and not self.skipPreloadedImage:
+          held = result
+          continue
         else:
-          self.imageCurrent = None
+          if self.historyIndex == -1:
+            self.imageCurrent = None
           self.skipPreloadedImage = False
         logging.debug('Deleting temp file "%s"' % result.filename)
         os.unlink(result.filename)
 
+    if held is not None and os.path.exists(held.filename):
+      os.unlink(held.filename)
+    self.flushPrefetch()
     self.thread = None
     logging.info('slideshow has ended')
 
@@ -341,6 +454,3 @@ class slideshow:
       tmp = self.cbStopped
       self.cbStopped = None
       tmp()
-
-#TODO:
-#- Once in history, STOP PRELOADING THE IMAGE, IT BREAKS THINGS BADLY
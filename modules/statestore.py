@@ -0,0 +1,112 @@
+# This file is part of photoframe (https://github.com/mrworf/photoframe).
+#
+# photoframe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# photoframe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with photoframe.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import json
+import logging
+import threading
+
+# Persists a JSON document without wearing out the SD card.
+#
+# Callers mark the document dirty whenever it changes and the store writes
+# it after MAX_CHANGES changes or MAX_DELAY seconds, whichever comes first.
+# Every write goes to a temporary file which is then renamed over the old
+# one, so a power loss leaves either the old or the new version behind,
+# never a truncated file.
+#
+class StateStore:
+  MAX_CHANGES = 20
+  MAX_DELAY = 30 # seconds
+
+  _STORES = []
+  _STORES_LOCK = threading.Lock()
+
+  def __init__(self, filename, provider, maxChanges=MAX_CHANGES, maxDelay=MAX_DELAY):
+    # provider is called to get the data to save
+    self.filename = filename
+    self.provider = provider
+    self.maxChanges = maxChanges
+    self.maxDelay = maxDelay
+    self.changes = 0
+    self.timer = None
+    self.lock = threading.RLock()
+
+    with StateStore._STORES_LOCK:
+      StateStore._STORES.append(self)
+
+  @staticmethod
+  def writeAtomic(filename, data):
+    tmpfile = '%s.%d.tmp' % (filename, threading.current_thread().ident)
+    try:
+      with open(tmpfile, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+      os.rename(tmpfile, filename)
+    except:
+      # Don't leave a half written file behind for every failed attempt
+      if os.path.exists(tmpfile):
+        os.unlink(tmpfile)
+      raise
+
+  @staticmethod
+  def flushAll():
+    with StateStore._STORES_LOCK:
+      stores = list(StateStore._STORES)
+    for store in stores:
+      store.flush()
+
+  def discard(self):
+    # Drops any pending changes and stops tracking this store
+    with self.lock:
+      if self.timer is not None:
+        self.timer.cancel()
+        self.timer = None
+      self.changes = 0
+    with StateStore._STORES_LOCK:
+      if self in StateStore._STORES:
+        StateStore._STORES.remove(self)
+
+  def isDirty(self):
+    return self.changes > 0
+
+  def markDirty(self, immediate=False):
+    with self.lock:
+      self.changes += 1
+      if immediate or self.changes >= self.maxChanges:
+        self.flush()
+      elif self.timer is None:
+        self.timer = threading.Timer(self.maxDelay, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+  def flush(self):
+    with self.lock:
+      if self.timer is not None:
+        self.timer.cancel()
+        self.timer = None
+      if self.changes == 0:
+        return True
+      try:
+        StateStore.writeAtomic(self.filename, self.provider())
+      except:
+        logging.exception('Unable to save "%s", will try again later', self.filename)
+        self.timer = threading.Timer(self.maxDelay, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+        return False
+      logging.debug('Saved "%s" (%d changes)', self.filename, self.changes)
+      self.changes = 0
+      return True
@@ -0,0 +1,144 @@
+# This file is part of photoframe (https://github.com/mrworf/photoframe).
+#
+# photoframe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# photoframe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with photoframe.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import logging
+import threading
+try:
+  from PIL import Image, ImageDraw, ImageFont
+  TEXTRENDER_DISABLE = False
+except ImportError:
+  logging.warning('PIL module not available, status screens will be rendered using ImageMagick')
+  TEXTRENDER_DISABLE = True
+
+# Renders status screens (white text centered on black, with an optional
+# grey footer) straight into a framebuffer-ready buffer, without spawning
+# ImageMagick. Glyphs are rendered once per font and then reused, which
+# makes a countdown or an error screen next to free.
+#
+class TextRenderer:
+  FONTS = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
+    '/usr/share/fonts/truetype/freefont/FreeSansBold.ttf',
+  ]
+  POINTSIZE = 32
+  MARGIN = 8 # pixels between text and screen edge
+  COLOR_MESSAGE = (255, 255, 255)
+  COLOR_FOOTER = (0x66, 0x66, 0x66)
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.font = None
+    self.glyphs = {}
+    self.enabled = False
+
+    if TEXTRENDER_DISABLE:
+      return
+    for filename in TextRenderer.FONTS:
+      if os.path.exists(filename):
+        try:
+          self.font = ImageFont.truetype(filename, TextRenderer.POINTSIZE)
+          ascent, descent = self.font.getmetrics()
+          self.lineHeight = ascent + descent
+          self.enabled = True
+          logging.debug('Using "%s" for status screens', filename)
+          break
+        except:
+          logging.exception('Unable to load font "%s"', filename)
+    if not self.enabled:
+      logging.warning('No usable font found, status screens will be rendered using ImageMagick')
+
+  def isEnabled(self):
+    return self.enabled
+
+  def _glyph(self, char):
+    # Returns (mask, advance) for the character, rendering it only once
+    glyph = self.glyphs.get(char, None)
+    if glyph is None:
+      width = self.font.getsize(char)[0]
+      mask = None
+      if width > 0 and not char.isspace():
+        mask = Image.new('L', (width, self.lineHeight), 0)
+        ImageDraw.Draw(mask).text((0, 0), char, font=self.font, fill=255)
+      glyph = (mask, width)
+      self.glyphs[char] = glyph
+    return glyph
+
+  def _measure(self, text):
+    return sum([self._glyph(c)[1] for c in text])
+
+  def _wrap(self, text, width):
+    # Same idea as ImageMagick's caption:, break on words and only split
+    # a word when it doesn't fit on a line by itself
+    lines = []
+    for paragraph in text.split('\n'):
+      line = ''
+      for word in paragraph.split(' '):
+        candidate = word if line == '' else line + ' ' + word
+        if self._measure(candidate) <= width:
+          line = candidate
+          continue
+        if line != '':
+          lines.append(line)
+        line = ''
+        for c in word:
+          if line != '' and self._measure(line + c) > width:
+            lines.append(line)
+            line = ''
+          line += c
+      lines.append(line)
+    return lines
+
+  def _draw(self, canvas, lines, y, color):
+    for line in lines:
+      x = (canvas.size[0] - self._measure(line)) / 2
+      for c in line:
+        mask, advance = self._glyph(c)
+        if mask is not None:
+          canvas.paste(color, (x, y), mask)
+        x += advance
+      y += self.lineHeight
+
+  def render(self, message, footer, width, height, xoffset, yoffset, format):
+    # Returns the raw frame in the given format (rgb, bgr, rgba or bgra)
+    # or None if it cannot be done without ImageMagick
+    if not self.enabled:
+      return None
+
+    if isinstance(message, str):
+      message = message.decode('utf-8', 'replace')
+    if isinstance(footer, str):
+      footer = footer.decode('utf-8', 'replace')
+
+    area = width - 2 * TextRenderer.MARGIN
+    with self.lock:
+      screen = Image.new('RGB', (width, height), (0, 0, 0))
+      lines = self._wrap(message, area)
+      self._draw(screen, lines, (height - len(lines) * self.lineHeight) / 2, TextRenderer.COLOR_MESSAGE)
+      if footer:
+        lines = self._wrap(footer, area)
+        self._draw(screen, lines, height - len(lines) * self.lineHeight, TextRenderer.COLOR_FOOTER)
+
+    # Place it the same way "-gravity center -extent WxH+X+Y" would
+    canvas = Image.new('RGB', (width + xoffset, height + yoffset), (0, 0, 0))
+    canvas.paste(screen, (xoffset / 2 - xoffset, yoffset / 2 - yoffset))
+    if len(format) == 4:
+      canvas = canvas.convert('RGBA')
+    try:
+      return canvas.tobytes('raw', format.upper())
+    except ValueError:
+      logging.warning('PIL cannot produce "%s", status screens will be rendered using ImageMagick', format)
+      self.enabled = False
+      return None
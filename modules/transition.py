@@ -0,0 +1,103 @@
+# This file is part of photoframe (https://github.com/mrworf/photoframe).
+#
+# photoframe is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# photoframe is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with photoframe.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import stat
+import mmap
+import time
+import logging
+try:
+  from PIL import Image
+  TRANSITION_DISABLE = False
+except ImportError:
+  logging.warning('PIL module not available, transitions will not work')
+  TRANSITION_DISABLE = True
+
+# Animates the change from one frame to the next, directly in the
+# (memory mapped) framebuffer.
+#
+# Instead of a fixed number of steps, each step is placed based on how
+# much time has passed, so a slow device (Pi Zero) simply shows fewer
+# steps. We also rest between steps so the transition never eats more
+# than CPU_BUDGET of a core.
+#
+class Transition:
+  MODES = ['none', 'crossfade', 'wipe']
+  FPS = 25
+  CPU_BUDGET = 0.5
+
+  @staticmethod
+  def isSupported(mode, depth):
+    # 16bit framebuffers need the rgb565 tool, which is too slow for this
+    return not TRANSITION_DISABLE and mode in Transition.MODES and mode != 'none' and depth in [24, 32]
+
+  @staticmethod
+  def run(device, mode, old, new, size, format, duration):
+    # Returns False if nothing could be shown, caller should just blit
+    if len(old) != len(new):
+      return False
+    rawmode = format.upper()
+    imode = 'RGBA' if len(format) == 4 else 'RGB'
+    try:
+      imgOld = Image.frombuffer(imode, size, old, 'raw', rawmode, 0, 1)
+      imgNew = Image.frombuffer(imode, size, new, 'raw', rawmode, 0, 1)
+    except:
+      logging.exception('Unable to prepare transition')
+      return False
+
+    try:
+      f = open(device, 'r+b')
+    except:
+      logging.exception('Unable to open "%s" for transition', device)
+      return False
+    try:
+      info = os.fstat(f.fileno())
+      if stat.S_ISREG(info.st_mode) and info.st_size < len(new):
+        # Emulated framebuffer is a plain file, it must be large enough
+        f.close()
+        return False
+      fb = mmap.mmap(f.fileno(), len(new))
+    except:
+      logging.exception('Unable to map "%s", no transition', device)
+      f.close()
+      return False
+
+    steps = 0
+    interval = 1.0 / Transition.FPS
+    start = time.time()
+    try:
+      while True:
+        begin = time.time()
+        progress = (begin - start) / duration
+        if progress >= 1.0:
+          break
+        if mode == 'wipe':
+          edge = int(size[0] * progress)
+          frame = imgOld.copy()
+          frame.paste(imgNew.crop((0, 0, edge, size[1])), (0, 0))
+        else:
+          frame = Image.blend(imgOld, imgNew, progress)
+        fb.seek(0)
+        fb.write(frame.tobytes('raw', rawmode))
+        steps += 1
+
+        spent = time.time() - begin
+        rest = max(interval - spent, spent * (1.0 - Transition.CPU_BUDGET) / Transition.CPU_BUDGET)
+        time.sleep(min(rest, max(0, start + duration - time.time())))
+    finally:
+      fb.close()
+      f.close()
+    logging.debug('Transition "%s" used %d steps in %.2fs', mode, steps, time.time() - start)
+    return True
@@ -18,6 +18,7 @@ import flask
 
 class BaseRoute:
   SIMPLE = False
+  CACHEABLE = False # Route provides its own caching headers
 
   class Mapping:
     def __init__(self, url):
@@ -18,17 +18,19 @@ import subprocess
 import logging
 
 from modules.helper import helper
+from modules.processor import ImageProcessor
 
 from baseroute import BaseRoute
 
 class RouteDetails(BaseRoute):
-  def setupex(self, displaymgr, drivermgr, colormatch, slideshow, servicemgr, settings):
+  def setupex(self, displaymgr, drivermgr, colormatch, slideshow, servicemgr, settings, processor):
     self.displaymgr = displaymgr
     self.drivermgr = drivermgr
     self.colormatch = colormatch
     self.slideshow = slideshow
     self.servicemgr = servicemgr
     self.settings = settings
+    self.processor = processor
 
     self.void = open(os.devnull, 'wb')
 
@@ -41,9 +43,26 @@ class RouteDetails(BaseRoute):
       result['status'] = self.displaymgr.current()
       return self.jsonify(result)
     elif about == 'current':
-      image, mime = self.displaymgr.get()
+      width = self.getRequest().args.get('width', None, type=int)
+      if width is not None and width <= 0:
+        # Page wasn't laid out yet, full size is better than a thumbnail
+        width = None
+      elif width is not None:
+        width = max(16, width)
+      # Browser already has it? Then don't bother
+      tag = self.displaymgr.getSnapshotTag(width)
+      if self.getRequest().headers.get('If-None-Match', None) == tag:
+        response = app.make_response(('', 304))
+        response.headers.set('ETag', tag)
+        return response
+      # Shares the workers with the slideshow, but always goes first
+      result = self.processor.run(ImageProcessor.PRIORITY_UI, 'snapshot', self.displaymgr.get, width)
+      if result is None:
+        return 'Unable to capture screen', 503
+      image, mime, tag = result
       response = app.make_response(image)
       response.headers.set('Content-Type', mime)
+      response.headers.set('ETag', tag)
       return response
     elif about == 'drivers':
       result = self.drivermgr.list().keys()
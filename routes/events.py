@@ -14,18 +14,64 @@
 # along with photoframe.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import json
+import time
+import threading
+from flask import Response
+
 from baseroute import BaseRoute
+from modules.events import Events
 
 class RouteEvents(BaseRoute):
+  STREAM_DURATION = 300 # Seconds before a stream ends, browser reconnects
+  KEEPALIVE = 15
+
   def setupex(self, events):
     self.events = events
+    self.lock = threading.Lock()
+    self.streams = 0
 
     self.addUrl('/events').addDefault('since', None).addDefault('id', None)
+    self.addUrl('/events/stream').addDefault('since', None).addDefault('id', None)
     self.addUrl('/events/<int:since>').addDefault('id', None)
     self.addUrl('/events/remove/<int:id>').addDefault('since', None)
 
+  def _streamLimit(self):
+    # Every stream occupies a web worker, make sure some are left for
+    # everything else
+    workers = self.server.workers
+    return max(0, min(workers // 2, workers - 1))
+
+  def _stream(self, since):
+    # Server-sent events, see https://html.spec.whatwg.org/multipage/server-sent-events.html
+    # The stream was counted when admitted by handle()
+    try:
+      end = time.time() + RouteEvents.STREAM_DURATION
+      yield 'retry: 3000\n\n'
+      while time.time() < end:
+        msgs = self.events.wait(since, RouteEvents.KEEPALIVE)
+        if len(msgs) == 0:
+          yield ': keepalive\n\n'
+          continue
+        for msg in msgs:
+          since = msg['id']
+          name = msg['message'] if msg['type'] == Events.TYPE_STATE else 'message'
+          yield 'id: %d\nevent: %s\ndata: %s\n\n' % (msg['id'], name, json.dumps(msg))
+    finally:
+      with self.lock:
+        self.streams -= 1
+
   def handle(self, app, since, id):
-    if since is not None:
+    if self.getRequest().path == '/events/stream':
+      with self.lock:
+        if self.streams >= self._streamLimit():
+          return 'Too many event streams', 503
+        # Count it now, or clients connecting at the same time all get in
+        self.streams += 1
+      # Browsers tell us where they were when reconnecting, new clients get all we have
+      since = self.getRequest().headers.get('Last-Event-ID', -1, type=int)
+      return Response(self._stream(since), mimetype='text/event-stream')
+    elif since is not None:
       return self.jsonify(self.events.getSince(since))
     elif id is not None:
       self.events.remove(id)
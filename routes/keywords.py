@@ -22,6 +22,7 @@ class RouteKeywords(BaseRoute):
     self.slideshow = slideshow
 
     self.addUrl('/keywords/<service>/help')
+    self.addUrl('/keywords/<service>/suggest')
     self.addUrl('/keywords/<service>')
     self.addUrl('/keywords/<service>/add').clearMethods().addMethod('POST')
     self.addUrl('/keywords/<service>/delete').clearMethods().addMethod('POST')
@@ -30,7 +31,10 @@ class RouteKeywords(BaseRoute):
 
   def handle(self, app, service, index=None):
     if self.getRequest().method == 'GET':
-      if 'source' in self.getRequest().url:
+      if self.getRequest().path.endswith('/suggest'):
+        # Checked first, the query itself may contain any of the words below
+        return self.jsonify({'suggestions' : self.servicemgr.suggestServiceKeywords(service, self.getRequest().args.get('q', ''))})
+      elif 'source' in self.getRequest().url:
         return self.redirect(self.servicemgr.sourceServiceKeywords(service, index))
       elif 'details' in self.getRequest().url:
         return self.jsonify(self.servicemgr.detailsServiceKeywords(service, index))
@@ -19,16 +19,23 @@ import shutil
 
 from baseroute import BaseRoute
 from modules.path import path
+from modules.statestore import StateStore
 
 class RouteMaintenance(BaseRoute):
-  def setupex(self, emulator, drivermgr, slideshow):
+  def setupex(self, emulator, drivermgr, slideshow, displaymgr):
     self.drivermgr = drivermgr
     self.emulator = emulator
     self.slideshow = slideshow
+    self.displaymgr = displaymgr
     self.void = open(os.devnull, 'wb')
 
     self.addUrl('/maintenance/<cmd>')
 
+  def _flushState(self):
+    # We're about to go away, make sure nothing is lost
+    StateStore.flushAll()
+    self.displaymgr.flushBootFrame()
+
   def handle(self, app, cmd):
     if cmd == 'reset':
       # Remove driver if active
@@ -43,12 +50,14 @@ class RouteMaintenance(BaseRoute):
         self.server.stop()
       return self.jsonify({'reset': True})
     elif cmd == 'reboot':
+      self._flushState()
       if not self.emulator:
         subprocess.call(['/sbin/reboot'], stderr=self.void);
       else:
         self.server.stop()
       return self.jsonify({'reboot' : True})
     elif cmd == 'shutdown':
+      self._flushState()
       if not self.emulator:
         subprocess.call(['/sbin/poweroff'], stderr=self.void);
       else:
@@ -70,6 +79,7 @@ class RouteMaintenance(BaseRoute):
       if self.emulator:
         return 'Cannot run update from emulation mode', 200
       if os.path.exists('update.sh'):
+        self._flushState()
         subprocess.Popen('/bin/bash update.sh 2>&1 | logger -t forced_update', shell=True)
         return 'Update in process', 200
       else:
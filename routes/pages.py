@@ -1,4 +1,3 @@
-
 # This file is part of photoframe (https://github.com/mrworf/photoframe).
 #
 # photoframe is free software: you can redistribute it and/or modify
@@ -15,23 +14,126 @@
 # along with photoframe.  If not, see <http://www.gnu.org/licenses/>.
 #
 import os
-from flask import send_from_directory
+import re
+import gzip
+import hashlib
+import logging
+import mimetypes
+import threading
+from StringIO import StringIO
 
 from baseroute import BaseRoute
 
+try:
+  import brotli
+  BROTLI = True
+except ImportError:
+  BROTLI = False
+
+# Static files are read once (and again if they change on disk) and kept
+# in memory with a content hash as ETag. Text files are also compressed
+# up front, so the Pi never compresses anything per request.
+#
+# Files with a version in their name (jquery-3.3.1.min.js) never change,
+# browsers may keep those for a year. Everything else must be revalidated,
+# which is a cheap 304 when nothing changed.
 class RoutePages(BaseRoute):
     SIMPLE = True
+    CACHEABLE = True
+    VERSIONED = re.compile('[-.]v?[0-9]+(\.[0-9]+)+[-.]')
+    COMPRESS = ['text/html', 'text/css', 'text/plain', 'application/javascript', 'application/json', 'image/svg+xml']
+    MAX_AGE = 365 * 24 * 3600
 
     def setup(self):
-        self.addUrl('/<path:file>')
-        self.addUrl('/').addDefault('file', None)
+      self.addUrl('/<path:file>')
+      self.addUrl('/').addDefault('file', None)
+
+      self.lock = threading.Lock()
+      self.assets = {}
+      self.root_dir = os.path.join(os.getcwd(), 'static')
+      count = 0
+      for folder, dirs, files in os.walk(self.root_dir):
+        for name in files:
+          if self._getAsset(os.path.relpath(os.path.join(folder, name), self.root_dir)) is not None:
+            count += 1
+      logging.info('Prepared %d static files%s', count, '' if BROTLI else ' (brotli unavailable)')
+
+    def _loadAsset(self, filename, info):
+      with open(filename, 'rb') as f:
+        data = f.read()
+      mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+      tag = hashlib.sha1(data).hexdigest()[0:16]
+      asset = {
+        'mtime' : info.st_mtime,
+        'size' : info.st_size,
+        'mimetype' : mimetype,
+        'versioned' : RoutePages.VERSIONED.search(os.path.basename(filename)) is not None,
+        'variants' : {None : (data, tag)}
+      }
+      if mimetype in RoutePages.COMPRESS:
+        buf = StringIO()
+        gz = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+        gz.write(data)
+        gz.close()
+        if len(buf.getvalue()) < len(data):
+          asset['variants']['gzip'] = (buf.getvalue(), tag + '-gz')
+        if BROTLI:
+          compressed = brotli.compress(data)
+          if len(compressed) < len(data):
+            asset['variants']['br'] = (compressed, tag + '-br')
+      return asset
+
+    def _getAsset(self, file):
+      filename = os.path.join(self.root_dir, file)
+      try:
+        info = os.stat(filename)
+      except OSError:
+        return None
+      if not os.path.isfile(filename):
+        return None
+      with self.lock:
+        asset = self.assets.get(file, None)
+      if asset is not None and asset['mtime'] == info.st_mtime and asset['size'] == info.st_size:
+        return asset
+      try:
+        asset = self._loadAsset(filename, info)
+      except:
+        logging.exception('Unable to load "%s"', filename)
+        return None
+      with self.lock:
+        self.assets[file] = asset
+      return asset
 
     def handle(self, app, **kwargs):
       file = kwargs['file']
       if file is None:
         file = 'index.html'
 
-      root_dir = os.path.join(os.getcwd(), 'static')
       if '..' in file:
         return 'File not found', 404
-      return send_from_directory(root_dir, file)
+      asset = self._getAsset(file)
+      if asset is None:
+        return 'File not found', 404
+
+      request = self.getRequest()
+      encoding = None
+      for e in ['br', 'gzip']:
+        if e in asset['variants'] and e in request.headers.get('Accept-Encoding', ''):
+          encoding = e
+          break
+      data, tag = asset['variants'][encoding]
+
+      if request.if_none_match.contains(tag):
+        response = app.make_response(('', 304))
+      else:
+        response = app.make_response(data)
+        response.headers['Content-Type'] = asset['mimetype']
+        if encoding is not None:
+          response.headers['Content-Encoding'] = encoding
+      response.set_etag(tag)
+      response.headers['Vary'] = 'Accept-Encoding'
+      if asset['versioned']:
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % RoutePages.MAX_AGE
+      else:
+        response.headers['Cache-Control'] = 'no-cache'
+      return response
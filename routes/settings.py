@@ -80,7 +80,8 @@ class RouteSettings(BaseRoute):
         self.powermanagement = shutdown(self.settingsMgr.getUser('shutdown-pin'))
       if key in ['imagesizing', 'randomize_images']:
         self.slideshow.createEvent("settingsChange")
-      self.settingsMgr.save()
+      # User made the change, don't risk losing it
+      self.settingsMgr.save(immediate=True)
       return self.jsonify({'status':status})
 
     elif self.getRequest().method == 'GET':
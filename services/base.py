@@ -13,14 +13,15 @@
 # You should have received a copy of the GNU General Public License
 # along with photoframe.  If not, see <http://www.gnu.org/licenses/>.
 #
-import hashlib
 import os
 import json
 import random
+import bisect
 import logging
 import requests
 import time
 import uuid
+import copy
 
 from modules.oauth import OAuth
 from modules.helper import helper
@@ -28,9 +29,10 @@ from modules.network import RequestResult
 from modules.network import RequestNoNetwork
 from modules.network import RequestInvalidToken
 from modules.network import RequestExpiredToken
-from modules.images import ImageHolder
+from modules.images import ImageHolder, AlbumIndex
 
 from modules.memory import MemoryManager
+from modules.statestore import StateStore
 
 # This is the base implementation of a service. It provides all the
 # basic features like OAuth and Authentication as well as state and
@@ -45,6 +47,7 @@ from modules.memory import MemoryManager
 #
 class BaseService:
   REFRESH_DELAY = 60*60 # Number of seconds before we refresh the index in case no photos
+  REFRESH_CONCURRENCY = 2 # Number of keywords which may be refreshed in parallel
   SERVICE_DEPRECATED = False
 
   STATE_ERROR = -1
@@ -63,13 +66,20 @@ class BaseService:
     self._NAME = name
     self._OAUTH = None
     self._CACHEMGR = None
+    self._REFRESHER = None
+    self._DEDUPEMGR = None
+
+    # Per keyword, which positions of its index can be shown on this display
+    # (orientation and mimetype), see _getEligible()
+    self._PARTITIONS = {}
+    self._ELIGIBLE = {}
 
     self._CURRENT_STATE = BaseService.STATE_UNINITIALIZED
     self._ERROR = None
 
     # NUM_IMAGES keeps track of how many images are being provided by each keyword
-    # As for now, unsupported images (mimetype, orientation) and already displayed images are NOT excluded due to simplicity,
-    # but it should still serve as a rough estimate to ensure that every image has a similar chance of being shown in "random_image_mode"!
+    # Unsupported images (mimetype, orientation) are NOT excluded here, once a keyword
+    # has been used, _ELIGIBLE holds the number which can actually be shown.
     # NEXT_SCAN is used to determine when a keyword should be re-indexed. This used in the case number of photos are zero to avoid hammering
     # services.
     self._STATE = {
@@ -89,6 +99,9 @@ class BaseService:
     self._DIR_BASE = self._prepareFolders(configDir)
     self._DIR_PRIVATE = os.path.join(self._DIR_BASE, 'private')
     self._FILE_STATE = os.path.join(self._DIR_BASE, 'state.json')
+    # Refresh threads change the state while it's written, a copy is made
+    # far quicker than the JSON so it's a lot less likely to trip on that
+    self._STORE = StateStore(self._FILE_STATE, lambda: copy.deepcopy(self._STATE))
 
     self.memory = MemoryManager(os.path.join(self._DIR_BASE, 'memory'))
 
@@ -98,6 +111,23 @@ class BaseService:
   def setCacheManager(self, cacheMgr):
     self._CACHEMGR = cacheMgr
 
+  def setRefresher(self, refresher):
+    self._REFRESHER = refresher
+
+  def setDedupeManager(self, dedupeMgr):
+    self._DEDUPEMGR = dedupeMgr
+
+  def _isDuplicate(self, image):
+    if self._DEDUPEMGR is None or not self._DEDUPEMGR.isEnabled():
+      return False
+    key = image.getCacheId()
+    if key is None:
+      return False
+    if self._DEDUPEMGR.getHash(key) is None and image.filename is not None and os.path.exists(image.filename):
+      # Local file, cheap enough to hash right away
+      self._DEDUPEMGR.add(key, image.filename)
+    return self._DEDUPEMGR.isDuplicate(key)
+
   def _prepareFolders(self, configDir):
     basedir = os.path.join(configDir, self._ID)
     if not os.path.exists(basedir):
@@ -157,12 +187,20 @@ class BaseService:
           logging.exception('Unable to load state for service')
           os.unlink(self._FILE_STATE)
 
-  def saveState(self):
+  def saveState(self, immediate=False):
     # Stores the state data under the unique ID for
-    # this service provider's instance
+    # this service provider's instance. Unless immediate is set,
+    # writes are coalesced (see StateStore) to spare the SD card.
     # normally you don't override this
-    with open(self._FILE_STATE, 'w') as f:
-      json.dump(self._STATE, f)
+    self._STORE.markDirty(immediate)
+
+  def flushState(self):
+    # Writes any pending state changes right away
+    self._STORE.flush()
+
+  def releaseState(self):
+    # Called when the service is deleted, pending changes are dropped
+    self._STORE.discard()
 
   ###[ Get info about instance ]###########################
 
@@ -176,18 +214,46 @@ class BaseService:
   def getId(self):
     return self._ID
 
+  def scheduleRefresh(self):
+    # Queues any keyword which hasn't been indexed or is due for a rescan,
+    # returns the keywords which have never been indexed.
+    unknown = []
+    if not self.needKeywords() or self._REFRESHER is None:
+      return unknown
+    if (self._NEED_OAUTH and (self._OAUTH is None or not self.hasOAuth())) or (self._NEED_CONFIG and not self.hasConfiguration()):
+      return unknown
+    for keyword in self.getKeywords():
+      if keyword not in self._STATE["_NUM_IMAGES"] or keyword not in self._STATE['_NEXT_SCAN'] or self._STATE['_NEXT_SCAN'][keyword] < time.time():
+        self._REFRESHER.schedule(self, keyword)
+        if keyword not in self._STATE["_NUM_IMAGES"]:
+          unknown.append(keyword)
+    return unknown
+
   def getImagesTotal(self):
     # return the total number of images provided by this service
     sum = 0
     if self.needKeywords():
+      if self._REFRESHER is None:
+        for keyword in self.getKeywords():
+          if keyword not in self._STATE["_NUM_IMAGES"] or keyword not in self._STATE['_NEXT_SCAN'] or self._STATE['_NEXT_SCAN'][keyword] < time.time():
+            logging.debug('Keywords either not scanned or we need to scan now')
+            self._getImagesFor(keyword) # Will make sure to get images
+            self._STATE['_NEXT_SCAN'][keyword] = time.time() + self.REFRESH_DELAY
+      else:
+        # Keywords we know nothing about must be indexed before we can answer,
+        # the rest keep their old count until the refresh is done
+        for keyword in self.scheduleRefresh():
+          self._REFRESHER.wait(self, keyword)
       for keyword in self.getKeywords():
-        if keyword not in self._STATE["_NUM_IMAGES"] or keyword not in self._STATE['_NEXT_SCAN'] or self._STATE['_NEXT_SCAN'][keyword] < time.time():
-          logging.debug('Keywords either not scanned or we need to scan now')
-          self._getImagesFor(keyword) # Will make sure to get images
-          self._STATE['_NEXT_SCAN'][keyword] = time.time() + self.REFRESH_DELAY
-        sum = sum + self._STATE["_NUM_IMAGES"][keyword]  
+        sum = sum + self.getImagesTotalFor(keyword)
     return sum
 
+  def getImagesTotalFor(self, keyword):
+    # Images of keyword which can be shown, if we know, otherwise all of them
+    if keyword in self._ELIGIBLE:
+      return self._ELIGIBLE[keyword]
+    return self._STATE["_NUM_IMAGES"].get(keyword, 0)
+
   def getImagesSeen(self):
     count = 0
     if self.needKeywords():
@@ -247,7 +313,7 @@ class BaseService:
       self._OAUTH.setOAuth(self._STATE['_OAUTH_CONFIG'])
       self.postSetup()
 
-    self.saveState()
+    self.saveState(immediate=True)
     return True
 
   def helpOAuthConfig(self):
@@ -266,7 +332,7 @@ class BaseService:
     # Removes previously negotiated OAuth
     self._STATE['_OAUTH_CONFIG'] = None
     self._STATE['_OAUTH_CONTEXT'] = None
-    self.saveState()
+    self.saveState(immediate=True)
 
   def startOAuth(self):
     # Returns a HTTP redirect to begin OAuth or None if
@@ -276,11 +342,11 @@ class BaseService:
   def finishOAuth(self, url):
     # Called when OAuth sequence has completed
     self._OAUTH.complete(url)
-    self.saveState()
+    self.saveState(immediate=True)
 
   def _setOAuthToken(self, token):
     self._STATE['_OAUTH_CONTEXT'] = token
-    self.saveState()
+    self.saveState(immediate=True)
 
   def _getOAuthToken(self):
     return self._STATE['_OAUTH_CONTEXT']
@@ -291,7 +357,7 @@ class BaseService:
       return
     logging.debug('Setting token to %s' % repr(token))
     self._STATE['_OAUTH_CONTEXT'] = token
-    self.saveState()
+    self.saveState(immediate=True)
 
   ###[ For services which require static auth ]###########################
 
@@ -305,7 +371,7 @@ class BaseService:
     # Setup any needed authentication data for this
     # service.
     self._STATE['_CONFIG'] = config
-    self.saveState()
+    self.saveState(immediate=True)
 
   def getConfiguration(self):
     return self._STATE['_CONFIG']
@@ -345,7 +411,7 @@ class BaseService:
     if tst['error'] is None:
       keywords = tst['keywords']
       self._STATE['_KEYWORDS'].append(keywords)
-      self.saveState()
+      self.saveState(immediate=True)
     return tst
 
   def getKeywords(self):
@@ -370,6 +436,14 @@ class BaseService:
     # Override to provide source url support
     return False
 
+  def getKeywordSuggestions(self, text):
+    # Override to help the user complete a keyword, returns a list of strings
+    return []
+
+  def hasKeywordSuggestions(self):
+    # Override to provide keyword suggestions
+    return False
+
   def removeKeywords(self, index):
     if index < 0 or index > (len(self._STATE['_KEYWORDS'])-1):
       logging.error('removeKeywords: Out of range %d' % index)
@@ -377,7 +451,7 @@ class BaseService:
     kw = self._STATE['_KEYWORDS'].pop(index)
     if kw in self._STATE['_NUM_IMAGES']:
       del self._STATE['_NUM_IMAGES'][kw]
-    self.saveState()
+    self.saveState(immediate=True)
     # Also kill the memory of this keyword
     self.memory.forget(kw)
     return True
@@ -395,7 +469,9 @@ class BaseService:
     totalImages = self.getImagesTotal()
     if totalImages == 0:
       return 0
-    numImages = [self._STATE['_NUM_IMAGES'][kw] for kw in self._STATE['_NUM_IMAGES']]
+    numImages = [self.getImagesTotalFor(kw) for kw in self.getKeywords()]
+    if sum(numImages) == 0:
+      return 0
     return helper.getWeightedRandomIndex(numImages)
 
   def getKeywordLink(self, index):
@@ -410,7 +486,7 @@ class BaseService:
 
   def setExtras(self, data):
     self._STATE['_EXTRAS'] = data
-    self.saveState()
+    self.saveState(immediate=True)
 
   ###[ Actual hard work ]###########################
 
@@ -460,6 +536,28 @@ class BaseService:
       self._STATE["_NUM_IMAGES"][keyword] = 0
     return images
 
+  def _refreshImagesFor(self, keyword):
+    # Called by the KeywordRefresher, runs outside of the slideshow thread
+    images = self.refreshImagesFor(keyword)
+    if images is None:
+      logging.warning('Refresh of "%s" failed, keeping existing index', keyword)
+      self._STATE['_NEXT_SCAN'][keyword] = time.time() + self.REFRESH_DELAY
+      return
+    count = 0
+    if len(images) > 0 and images[0].error is None:
+      count = len(images)
+    self._STATE["_NUM_IMAGES"][keyword] = count
+    self._STATE['_NEXT_SCAN'][keyword] = time.time() + self.REFRESH_DELAY
+
+  def refreshImagesFor(self, keyword):
+    # Override this if your service caches the index for a keyword. It should
+    # build a fresh index and replace the old one in one go (so the slideshow
+    # never sees a half-done index) and then return the new list of images,
+    # or None if it failed (in which case the old index is kept).
+    #
+    # By default, simply calls getImagesFor()
+    return self.getImagesFor(keyword)
+
   def getImagesFor(self, keyword):
     # You need to override this function if your service needs keywords and
     # you want to use 'selectImageFromAlbum' of the baseService class
@@ -478,11 +576,18 @@ class BaseService:
     return [ ImageHolder().setError('getImagesFor() not implemented') ]
 
   def _clearImagesFor(self, keyword):
+    self._PARTITIONS.pop(keyword, None)
+    self._ELIGIBLE.pop(keyword, None)
     self._STATE["_NUM_IMAGES"].pop(keyword, None)
     self._STATE['_NEXT_SCAN'].pop(keyword, None)
     self.memory.forget(keyword)
     self.clearImagesFor(keyword)
 
+  def _resetMemoryFor(self, keyword):
+    # Rewinds what has been shown but keeps the index, so no re-indexing
+    # is needed to start over
+    self.memory.forget(keyword)
+
   def clearImagesFor(self, keyword):
     # You can hook this function to do any additional needed cleanup
     # keyword is the item for which you need to clear the images for
@@ -531,12 +636,15 @@ class BaseService:
         return images[0]
       self.saveState()
 
-      image = self.selectRandomImage(keyword, images, supportedMimeTypes, displaySize)
-      if image is None:
-        self.setIndex(0)
-        continue
-
-      return self.fetchImage(image, destinationDir, supportedMimeTypes, displaySize)
+      # fetchImage returns None if the photo turned out to be a duplicate
+      while True:
+        image = self.selectRandomImage(keyword, images, supportedMimeTypes, displaySize)
+        if image is None:
+          break
+        result = self.fetchImage(image, destinationDir, supportedMimeTypes, displaySize)
+        if result is not None:
+          return result
+      self.setIndex(0)
     return None
 
   def generateFilename(self):
@@ -579,6 +687,15 @@ class BaseService:
         image.setFilename(filename)
     if image.filename is not None:
       image.setMimetype(helper.getMimetype(image.filename))
+      if self._DEDUPEMGR is not None:
+        self._DEDUPEMGR.add(image.getCacheId(), image.filename)
+        # First time we see it, so it wasn't caught when it was selected.
+        # It's already remembered, so it won't be picked again this round.
+        if self._DEDUPEMGR.isDuplicate(image.getCacheId()):
+          logging.info('Skipping "%s", looks the same as a photo already shown', image.id)
+          if image.filename == filename and os.path.exists(filename):
+            os.unlink(filename)
+          return None
     return image
 
   def selectNextImageFromAlbum(self, destinationDir, supportedMimeTypes, displaySize):
@@ -608,47 +725,74 @@ class BaseService:
         return images[0]
       self.saveState()
 
-      image = self.selectNextImage(keyword, images, supportedMimeTypes, displaySize)
-      if image is None:
-        self.setIndex(0)
-        continue
-
-      return self.fetchImage(image, destinationDir, supportedMimeTypes, displaySize)
+      # fetchImage returns None if the photo turned out to be a duplicate
+      while True:
+        image = self.selectNextImage(keyword, images, supportedMimeTypes, displaySize)
+        if image is None:
+          break
+        result = self.fetchImage(image, destinationDir, supportedMimeTypes, displaySize)
+        if result is not None:
+          return result
+      self.setIndex(0)
     return None
 
+  def _isEligible(self, image, supportedMimeTypes, displaySize):
+    return self.isCorrectOrientation(image.dimensions, displaySize) and (image.mimetype is None or image.mimetype in supportedMimeTypes)
+
+  def _getEligible(self, keyword, images, supportedMimeTypes, displaySize):
+    # Returns the positions in images which can be shown on this display.
+    # Worked out once per index (and display), since walking thousands of
+    # unusable items for every slide gets expensive.
+    portrait = None
+    if displaySize['force_orientation'] != 0:
+      portrait = displaySize['width'] <= displaySize['height']
+    criteria = (portrait, tuple(sorted(supportedMimeTypes)))
+
+    cached = self._PARTITIONS.get(keyword, None)
+    if cached is not None and cached[0] is images and cached[1] == len(images) and cached[2] == criteria:
+      return cached[3]
+
+    if isinstance(images, AlbumIndex):
+      positions = images.getEligible(portrait, supportedMimeTypes)
+    else:
+      positions = [i for i in range(0, len(images)) if self._isEligible(images[i], supportedMimeTypes, displaySize)]
+    self._PARTITIONS[keyword] = (images, len(images), criteria, positions)
+    self._ELIGIBLE[keyword] = len(positions)
+    return positions
+
   def selectRandomImage(self, keywords, images, supportedMimeTypes, displaySize):
-    imageCount = len(images)
+    positions = self._getEligible(keywords, images, supportedMimeTypes, displaySize)
+    imageCount = len(positions)
+    if imageCount == 0:
+      return None
     index = random.SystemRandom().randint(0, imageCount-1)
 
-    logging.debug('There are %d images total' % imageCount)
+    logging.debug('There are %d images total, %d can be shown' % (len(images), imageCount))
     for i in range(0, imageCount):
-      image = images[(index + i) % imageCount]
+      position = positions[(index + i) % imageCount]
+      image = images[position]
 
       orgFilename = image.filename if image.filename is not None else image.id
       if self.memory.seen(image.id, keywords):
         logging.debug("Skipping already displayed image '%s'!" % orgFilename)
         continue
 
-      # No matter what, we need to track that we considered this image
+      # Once considered, don't try it again this round
       self.memory.remember(image.id, keywords)
 
-      if not self.isCorrectOrientation(image.dimensions, displaySize):
-        logging.debug("Skipping image '%s' due to wrong orientation!" % orgFilename)
-        continue
-      if image.mimetype is not None and image.mimetype not in supportedMimeTypes:
-        # Make sure we don't get a video, unsupported for now (gif is usually bad too)
-        logging.debug('Skipping unsupported media: %s' % (image.mimetype))
+      if self._isDuplicate(image):
+        logging.debug("Skipping image '%s', already shown from another album" % orgFilename)
         continue
 
-      self.setIndex((index + i) % imageCount)
+      self.setIndex(position)
       return image
     return None
 
   def selectNextImage(self, keywords, images, supportedMimeTypes, displaySize):
-    imageCount = len(images)
+    positions = self._getEligible(keywords, images, supportedMimeTypes, displaySize)
     index = self.getIndexImage()
 
-    for i in range(index, imageCount):
+    for i in positions[bisect.bisect_left(positions, index):]:
       image = images[i]
 
       orgFilename = image.filename if image.filename is not None else image.id
@@ -656,15 +800,11 @@ class BaseService:
         logging.debug("Skipping already displayed image '%s'!" % orgFilename)
         continue
 
-      # No matter what, we need to track that we considered this image
+      # Once considered, don't try it again this round
       self.memory.remember(image.id, keywords)
 
-      if not self.isCorrectOrientation(image.dimensions, displaySize):
-        logging.debug("Skipping image '%s' due to wrong orientation!" % orgFilename)
-        continue
-      if image.mimetype is not None and image.mimetype not in supportedMimeTypes:
-        # Make sure we don't get a video, unsupported for now (gif is usually bad too)
-        logging.debug('Skipping unsupported media: %s' % (image.mimetype))
+      if self._isDuplicate(image):
+        logging.debug("Skipping image '%s', already shown from another album" % orgFilename)
         continue
 
       self.setIndex(i)
@@ -760,13 +900,7 @@ class BaseService:
     return self._DIR_PRIVATE
 
   def hashString(self, text):
-    if type(text) is not unicode:
-      # make sure it's unicode
-      a = text.decode('ascii', errors='replace')
-    else:
-      a = text
-    a = a.encode('utf-8', errors='replace')
-    return hashlib.sha1(a).hexdigest()
+    return helper.hashString(text)
 
   def createImageHolder(self):
     return ImageHolder()
@@ -18,16 +18,37 @@ import os
 import json
 import logging
 import time
+import threading
 
 from modules.network import RequestResult
 from modules.helper import helper
+from modules.statestore import StateStore
+from modules.images import AlbumIndex
 
 class GooglePhotos(BaseService):
   SERVICE_NAME = 'GooglePhotos'
   SERVICE_ID = 2
   MAX_ITEMS = 8000
+  # Only ask for what we use, it's a fraction of a full mediaItem
+  ITEM = 'id,productUrl,mimeType,mediaMetadata(width,height)'
+  ITEM_FIELDS = 'nextPageToken,mediaItems(%s)' % ITEM
+  ID_FIELDS = 'nextPageToken,mediaItems(id)' # Enough to tell what has changed
+  BATCH_FIELDS = 'mediaItemResults(mediaItem(%s))' % ITEM
+  BATCH_SIZE = 50 # API max for mediaItems:batchGet
+  # Content which doesn't belong on a photoframe, only works for "latest"
+  EXCLUDED_CATEGORIES = ['SCREENSHOTS', 'RECEIPTS', 'DOCUMENTS', 'WHITEBOARDS', 'UTILITY']
+  # Albums are resolved using a catalog instead of paging through all of them
+  ALBUM_FIELDS = 'nextPageToken,%s(id,title,productUrl,mediaItemsCount)'
+  CATALOG_TTL = 24 * 3600 # Seconds before the catalog is fetched again
+  CATALOG_RECHECK = 60 # Seconds before an unknown title causes another lookup
+  SUGGEST_MAX = 20
 
   def __init__(self, configDir, id, name):
+    self._INDEX_CACHE = {}
+    self._CATALOG = None
+    self._CATALOG_INDEX = {}
+    self._CATALOG_LOCK = threading.Lock()
+    self._CATALOG_REFRESHING = False
     BaseService.__init__(self, configDir, id, name, needConfig=False, needOAuth=True)
 
   def getOAuthScope(self):
@@ -102,28 +123,22 @@ class GooglePhotos(BaseService):
       return 'Out of range, index = %d' % index
     keyword = keys[index]
 
-    # This is not going to be fast...
-    data = self.getImagesFor(keyword, rawReturn=True)
+    # Statistics are gathered when the album is indexed
+    stats = self._getStats(keyword)
+    if stats is None:
+      return {'short' : 'No items have been fetched from this album yet', 'long' : []}
     mimes = helper.getSupportedTypes()
-    memory = self.memory.getList(keyword)
+    types = stats['types']
 
-    countv = 0
+    countv = stats['videos']
     counti = 0
     countu = 0
-    types = {}
-    for entry in data:
-      if entry['mimeType'].startswith('video/'):
-        countv += 1
-      elif entry['mimeType'].startswith('image/'):
-        if entry['mimeType'].lower() in mimes:
-          counti += 1
+    for mime in types:
+      if mime.startswith('image/'):
+        if mime.lower() in mimes:
+          counti += types[mime]
         else:
-          countu += 1
-
-      if entry['mimeType'] in types:
-        types[entry['mimeType']] += 1
-      else:
-        types[entry['mimeType']] = 1
+          countu += types[mime]
 
     longer = ['Below is a breakdown of the content found in this album']
     unsupported = []
@@ -140,8 +155,11 @@ class GooglePhotos(BaseService):
       longer.extend(unsupported)
     if countu > 0:
       extra = ' where %d is not yet unsupported' % countu
+    eligible = ''
+    if keyword in self._ELIGIBLE:
+      eligible = ', %d can be shown on this display' % self._ELIGIBLE[keyword]
     return {
-      'short': '%d items fetched from album, %d images%s, %d videos, %d is unknown. %d has been shown' % (len(data), counti + countu, extra, countv, len(data) - counti - countv, len(memory)),
+      'short': '%d items fetched from album, %d images%s, %d videos, %d is unknown%s. %d has been shown' % (stats['total'], counti + countu, extra, countv, stats['total'] - counti - countv, eligible, self.memory.count(keyword)),
       'long' : longer
     }
 
@@ -220,6 +238,9 @@ class GooglePhotos(BaseService):
             'mediaTypes': [
               'PHOTO'
             ]
+          },
+          'contentFilter': {
+            'excludedContentCategories': GooglePhotos.EXCLUDED_CATEGORIES
           }
         }
       }
@@ -231,10 +252,6 @@ class GooglePhotos(BaseService):
     return result
 
   def translateKeywordToId(self, keyword):
-    albumid = None
-    source = None
-    albumname = None
-
     if keyword == '':
       logging.error('Cannot use blank album name')
       return None
@@ -242,57 +259,158 @@ class GooglePhotos(BaseService):
     if keyword == 'latest':
       return None
 
-    logging.debug('Query Google Photos for album named "%s"', keyword)
-    url = 'https://photoslibrary.googleapis.com/v1/albums'
-    params={'pageSize':50} #50 is api max
+    album = self._findAlbum(keyword)
+    if album is None:
+      return None
+    logging.debug('Found album: ' + repr(album))
+    return {'albumId': album['id'], 'sourceUrl' : album['productUrl'], 'albumName' : album['title']}
+
+  def hasKeywordSuggestions(self):
+    return True
+
+  def getKeywordSuggestions(self, text):
+    # Album titles starting with text first, then those containing it. What
+    # we have is good enough while typing, a stale catalog is refreshed in
+    # the background
+    text = self._normalizeTitle(text)
+    with self._CATALOG_LOCK:
+      self._loadCatalog()
+      now = time.time()
+      stale = now - self._CATALOG['updated'] > GooglePhotos.CATALOG_TTL
+      recheck = now - self._CATALOG['checked'] > GooglePhotos.CATALOG_RECHECK
+      if stale and recheck and not self._CATALOG_REFRESHING:
+        self._CATALOG_REFRESHING = True
+        thread = threading.Thread(target=self._refreshCatalogBackground, name='GooglePhotos-catalog')
+        thread.daemon = True
+        thread.start()
+      titles = [t for t in self._CATALOG_INDEX if text in t]
+      titles.sort(key=lambda t: (not t.startswith(text), t))
+      return [self._lookupAlbum(t)['title'] for t in titles[:GooglePhotos.SUGGEST_MAX]]
+
+  def _normalizeTitle(self, title):
+    return title.upper().lower().strip()
+
+  def _catalogFilename(self):
+    return os.path.join(self.getStoragePath(), 'albums.json')
+
+  def _loadCatalog(self):
+    # Must be called holding _CATALOG_LOCK
+    if self._CATALOG is not None:
+      return
+    self._CATALOG = {'updated' : 0, 'checked' : 0, 'albums' : {}}
+    filename = self._catalogFilename()
+    if os.path.exists(filename):
+      try:
+        with open(filename, 'r') as f:
+          self._CATALOG = json.load(f)
+      except:
+        logging.exception('Album catalog is corrupt, ignoring it')
+    self._indexCatalog()
+
+  def _indexCatalog(self):
+    # Normalized title to album ids, own albums before shared ones
+    self._CATALOG_INDEX = {}
+    for album in self._CATALOG['albums'].values():
+      self._CATALOG_INDEX.setdefault(self._normalizeTitle(album['title']), []).append(album)
+    for title in self._CATALOG_INDEX:
+      self._CATALOG_INDEX[title].sort(key=lambda a: a['shared'])
+
+  def _lookupAlbum(self, keyword):
+    # Must be called holding _CATALOG_LOCK
+    albums = self._CATALOG_INDEX.get(keyword, None)
+    if albums is None:
+      return None
+    return albums[0]
+
+  def _findAlbum(self, keyword):
+    with self._CATALOG_LOCK:
+      self._loadCatalog()
+      now = time.time()
+      stale = now - self._CATALOG['updated'] > GooglePhotos.CATALOG_TTL
+      recheck = now - self._CATALOG['checked'] > GooglePhotos.CATALOG_RECHECK
+      album = self._lookupAlbum(keyword)
+    if stale:
+      self._refreshCatalog()
+    elif album is None and recheck:
+      # Probably a new album, no need to fetch them all to find it
+      self._refreshCatalog(keyword)
+    else:
+      return album
+    with self._CATALOG_LOCK:
+      return self._lookupAlbum(keyword)
+
+  def _fetchAlbums(self, kind, want=None):
+    # Pages through albums or sharedAlbums. Stops early if an album titled want
+    # is found. Returns (albums, complete) or None if it fails.
+    url = 'https://photoslibrary.googleapis.com/v1/%s' % kind
+    params = {'pageSize' : 50, 'fields' : GooglePhotos.ALBUM_FIELDS % kind} #50 is api max
+    result = []
     while True:
       data = self.requestUrl(url, params=params)
       if not data.isSuccess():
+        logging.warning('Unable to list %s (%d)', kind, data.httpcode)
         return None
       data = json.loads(data.content)
-      for i in range(len(data['albums'])):
-        if 'title' in data['albums'][i]:
-          logging.debug('Album: %s' % data['albums'][i]['title'])
-        if 'title' in data['albums'][i] and data['albums'][i]['title'].upper().lower().strip() == keyword:
-          logging.debug('Found album: ' + repr(data['albums'][i]))
-          albumname = data['albums'][i]['title']
-          albumid = data['albums'][i]['id']
-          source = data['albums'][i]['productUrl']
-          break
-      if albumid is None and 'nextPageToken' in data:
-        logging.debug('Another page of albums available')
-        params['pageToken'] = data['nextPageToken']
-        continue
-      break
-
-    if albumid is None:
-      url = 'https://photoslibrary.googleapis.com/v1/sharedAlbums'
-      params = {'pageSize':50}#50 is api max
-      while True:
-        data = self.requestUrl(url, params=params)
-        if not data.isSuccess():
-          return None
-        data = json.loads(data.content)
-        if 'sharedAlbums' not in data:
-          logging.debug('User has no shared albums')
-          break
-        for i in range(len(data['sharedAlbums'])):
-          if 'title' in data['sharedAlbums'][i]:
-            logging.debug('Shared Album: %s' % data['sharedAlbums'][i]['title'])
-          if 'title' in data['sharedAlbums'][i] and data['sharedAlbums'][i]['title'].upper().lower().strip() == keyword:
-            albumname = data['sharedAlbums'][i]['title']
-            albumid = data['sharedAlbums'][i]['id']
-            source = data['sharedAlbums'][i]['productUrl']
-            break
-        if albumid is None and 'nextPageToken' in data:
-          logging.debug('Another page of shared albums available')
-          params['pageToken'] = data['nextPageToken']
+      for entry in data.get(kind, []):
+        if 'title' not in entry:
           continue
+        result.append({
+          'id' : entry['id'],
+          'title' : entry['title'],
+          'count' : int(entry.get('mediaItemsCount', 0)),
+          'productUrl' : entry.get('productUrl', None),
+          'shared' : kind == 'sharedAlbums'
+        })
+        if want is not None and self._normalizeTitle(entry['title']) == want:
+          return result, False
+      if 'nextPageToken' not in data:
+        break
+      logging.debug('Another page of %s available', kind)
+      params['pageToken'] = data['nextPageToken']
+    return result, True
+
+  def _refreshCatalogBackground(self):
+    try:
+      self._refreshCatalog()
+    except:
+      logging.exception('Failed to refresh album catalog')
+    finally:
+      with self._CATALOG_LOCK:
+        self._CATALOG_REFRESHING = False
+
+  def _refreshCatalog(self, want=None):
+    # Without want, the catalog is replaced. With it, whatever was fetched
+    # before finding it is merged and the rest waits for the next full refresh.
+    logging.debug('Refreshing album catalog%s', '' if want is None else ' looking for "%s"' % want)
+    albums = {}
+    complete = True
+    for kind in ['albums', 'sharedAlbums']:
+      result = self._fetchAlbums(kind, want)
+      if result is None:
+        # Don't try again until CATALOG_RECHECK has passed
+        with self._CATALOG_LOCK:
+          self._CATALOG['checked'] = time.time()
+        return False
+      for album in result[0]:
+        # Own albums also show up as shared if shared
+        if album['id'] not in albums:
+          albums[album['id']] = album
+      if not result[1]:
+        complete = False
         break
 
-    if albumid is None:
-      return None
-    return {'albumId': albumid, 'sourceUrl' : source, 'albumName' : albumname}
+    with self._CATALOG_LOCK:
+      now = time.time()
+      if complete:
+        self._CATALOG = {'updated' : now, 'checked' : now, 'albums' : albums}
+      else:
+        for id in albums:
+          if id not in self._CATALOG['albums'] or not albums[id]['shared']:
+            self._CATALOG['albums'][id] = albums[id]
+        self._CATALOG['checked'] = now
+      self._indexCatalog()
+      StateStore.writeAtomic(self._catalogFilename(), self._CATALOG)
+    return True
 
   def selectImageFromAlbum(self, destinationDir, supportedMimeTypes, displaySize, randomize):
     result = BaseService.selectImageFromAlbum(self, destinationDir, supportedMimeTypes, displaySize, randomize)
@@ -312,46 +430,172 @@ class GooglePhotos(BaseService):
     return (time.time() - os.stat(filename).st_mtime) / 3600
 
   def clearImagesFor(self, keyword):
+    self._INDEX_CACHE.pop(keyword, None)
     filename = os.path.join(self.getStoragePath(), self.hashString(keyword) + '.json')
     if os.path.exists(filename):
       logging.info('Cleared image information for %s' % keyword)
       os.unlink(filename)
+    filename = self._metaFilename(keyword)
+    if os.path.exists(filename):
+      os.unlink(filename)
+
+  def _metaFilename(self, keyword):
+    return os.path.join(self.getStoragePath(), self.hashString(keyword) + '.meta.json')
+
+  def _loadMeta(self, keyword):
+    filename = self._metaFilename(keyword)
+    if os.path.exists(filename):
+      try:
+        with open(filename, 'r') as f:
+          return json.load(f)
+      except:
+        logging.exception('Metadata for "%s" is corrupt, ignoring it', keyword)
+    return {}
+
+  def _saveMeta(self, keyword, meta):
+    StateStore.writeAtomic(self._metaFilename(keyword), meta)
+
+  def _updateMeta(self, keyword, items):
+    # Keeps the album's statistics next to the index, so details never have to
+    # go through all items
+    types = {}
+    for entry in items:
+      types[entry['mimeType']] = types.get(entry['mimeType'], 0) + 1
+    meta = self._loadMeta(keyword)
+    meta.pop('mediaItemsCount', None) # No longer used to detect changes
+    meta['stats'] = {
+      'total' : len(items),
+      'videos' : sum([types[m] for m in types if m.startswith('video/')]),
+      'types' : types
+    }
+    self._saveMeta(keyword, meta)
+
+  def _getStats(self, keyword):
+    meta = self._loadMeta(keyword)
+    if 'stats' not in meta:
+      # Indexed before statistics were kept, one-time cost
+      items = self.getImagesFor(keyword, rawReturn=True)
+      if items is None:
+        return None
+      self._updateMeta(keyword, items)
+      meta = self._loadMeta(keyword)
+    return meta['stats']
+
+  def _fetchItems(self, keyword, fields=ITEM_FIELDS):
+    # Pages through all items for the keyword, fields decides what we get
+    # for each item. Returns None if the keyword cannot be queried or if a
+    # request failed, since a partial listing can't tell what was removed.
+    params = self.getQueryForKeyword(keyword)
+    if params is None:
+      logging.error('Unable to create query the keyword "%s"', keyword)
+      return None
+
+    result = []
+    url = 'https://photoslibrary.googleapis.com/v1/mediaItems:search'
+    maxItems = GooglePhotos.MAX_ITEMS # Should be configurable
+
+    while len(result) < maxItems:
+      data = self.requestUrl(url, params={'fields' : fields}, data=params, usePost=True)
+      if not data.isSuccess():
+        logging.warning('Requesting photo failed with status code %d', data.httpcode)
+        logging.warning('More details: ' + repr(data.content))
+        return None
+      else:
+        data = json.loads(data.content)
+        if 'mediaItems' not in data:
+          break
+        logging.debug('Got %d entries, adding it to existing %d entries', len(data['mediaItems']), len(result))
+        result += data['mediaItems']
+        if 'nextPageToken' not in data:
+          break
+        params['pageToken'] = data['nextPageToken']
+        logging.debug('Fetching another result-set for this keyword')
+    return result[0:maxItems]
+
+  def _fetchItemsById(self, ids):
+    # Gets the details of specific items, returns None if it failed. Items
+    # which can't be found are left out.
+    result = []
+    url = 'https://photoslibrary.googleapis.com/v1/mediaItems:batchGet'
+    for i in range(0, len(ids), GooglePhotos.BATCH_SIZE):
+      data = self.requestUrl(url, params={'mediaItemIds' : ids[i:i+GooglePhotos.BATCH_SIZE], 'fields' : GooglePhotos.BATCH_FIELDS})
+      if not data.isSuccess():
+        logging.warning('Requesting photos failed with status code %d', data.httpcode)
+        return None
+      data = json.loads(data.content)
+      for entry in data.get('mediaItemResults', []):
+        if 'mediaItem' in entry:
+          result.append(entry['mediaItem'])
+    return result
+
+  def _fetchAlbum(self, keyword, filename):
+    # Downloads the complete index for a keyword, stored under filename.
+    # Returns the items or None if it failed
+    result = self._fetchItems(keyword)
+    if result is None:
+      return None
+    if len(result) == 0:
+      logging.error('No result returned for keyword "%s"!', keyword)
+      return None
+
+    StateStore.writeAtomic(filename, result)
+    self._updateMeta(keyword, result)
+    return result
+
+  def refreshImagesFor(self, keyword):
+    # Instead of downloading everything again, only get what has changed.
+    # Memory is left alone, so what has been shown stays shown.
+    filename = os.path.join(self.getStoragePath(), self.hashString(keyword) + '.json')
+    albumdata = None
+    if os.path.exists(filename):
+      albumdata = self.getImagesFor(keyword, rawReturn=True)
+    if albumdata is None:
+      albumdata = self._fetchAlbum(keyword, filename)
+      if albumdata is None:
+        return None
+      return self.parseAlbumInfo(albumdata, keyword)
+
+    # Listing just the ids is cheap, comparing them to what we have tells
+    # what was added and removed (even when the count stays the same) so
+    # only the new items need to be fetched. For "latest" it's also what
+    # drops items which were deleted or fell out of the window. An album
+    # which was emptied ends up with an empty index.
+    listing = self._fetchItems(keyword, fields=GooglePhotos.ID_FIELDS)
+    if listing is None:
+      return None
+    ids = [entry['id'] for entry in listing]
+    if ids == [entry['id'] for entry in albumdata]:
+      logging.info('"%s" is unchanged (%d items), keeping index', keyword, len(ids))
+      os.utime(filename, None)
+      return self.parseAlbumInfo(albumdata, keyword)
+
+    known = dict([(entry['id'], entry) for entry in albumdata])
+    missing = [i for i in ids if i not in known]
+    logging.info('"%s" has changed, %d new and %d removed items', keyword, len(missing), len(set(known) - set(ids)))
+    found = self._fetchItemsById(missing)
+    if found is None:
+      return None
+    for entry in found:
+      known[entry['id']] = entry
+    items = [known[i] for i in ids if i in known]
+    StateStore.writeAtomic(filename, items)
+    self._updateMeta(keyword, items)
+    # Don't let items which have been removed count as seen
+    self.memory.prune(keyword, ids)
+    return self.parseAlbumInfo(items, keyword)
 
   def getImagesFor(self, keyword, rawReturn=False):
     filename = os.path.join(self.getStoragePath(), self.hashString(keyword) + '.json')
-    result = []
+    if not rawReturn and os.path.exists(filename):
+      # Parsing thousands of items for every slide adds up, reuse it until the file changes
+      cached = self._INDEX_CACHE.get(keyword, None)
+      if cached is not None and cached[0] == os.stat(filename).st_mtime:
+        return cached[1]
     if not os.path.exists(filename):
       # First time, translate keyword into albumid
-      params = self.getQueryForKeyword(keyword)
-      if params is None:
-        logging.error('Unable to create query the keyword "%s"', keyword)
-        return [BaseService.createImageHolder(self).setError('Unable to get photos using keyword "%s"' % keyword)]
-
-      url = 'https://photoslibrary.googleapis.com/v1/mediaItems:search'
-      maxItems = GooglePhotos.MAX_ITEMS # Should be configurable
-
-      while len(result) < maxItems:
-        data = self.requestUrl(url, data=params, usePost=True)
-        if not data.isSuccess():
-          logging.warning('Requesting photo failed with status code %d', data.httpcode)
-          logging.warning('More details: ' + repr(data.content))
-          break
-        else:
-          data = json.loads(data.content)
-          if 'mediaItems' not in data:
-            break
-          logging.debug('Got %d entries, adding it to existing %d entries', len(data['mediaItems']), len(result))
-          result += data['mediaItems']
-          if 'nextPageToken' not in data:
-            break
-          params['pageToken'] = data['nextPageToken']
-          logging.debug('Fetching another result-set for this keyword')
-
-      if len(result) > 0:
-        with open(filename, 'w') as f:
-          json.dump(result, f)
-      else:
-        logging.error('No result returned for keyword "%s"!', keyword)
+      if self._fetchAlbum(keyword, filename) is None:
+        if self.getQueryForKeyword(keyword) is None:
+          return [BaseService.createImageHolder(self).setError('Unable to get photos using keyword "%s"' % keyword)]
         return []
 
     # Now try loading
@@ -372,25 +616,24 @@ class GooglePhotos(BaseService):
         albumdata = None
     if rawReturn:
       return albumdata
-    return self.parseAlbumInfo(albumdata, keyword)
+    images = self.parseAlbumInfo(albumdata, keyword)
+    if images is not None and os.path.exists(filename):
+      self._INDEX_CACHE[keyword] = (os.stat(filename).st_mtime, images)
+    return images
 
   def parseAlbumInfo(self, data, keyword):
     # parse GooglePhoto specific keys into a format that the base service can understand
     if data is None:
       return None
-    parsedImages = []
+    parsedImages = AlbumIndex(provider=self, source=keyword, cacheAllow=True)
+    supported = helper.getSupportedTypes()
     for entry in data:
-      if entry['mimeType'] not in helper.getSupportedTypes():
+      if entry['mimeType'] not in supported:
         continue
       try:
-        item = BaseService.createImageHolder(self)
-        item.setId(entry['id'])
-        item.setSource(entry['productUrl']).setMimetype(entry['mimeType'])
-        item.setDimensions(entry['mediaMetadata']['width'], entry['mediaMetadata']['height'])
-        item.allowCache(True)
-        item.setContentProvider(self)
-        item.setContentSource(keyword)
-        parsedImages.append(item)
+        width = int(entry['mediaMetadata']['width'])
+        height = int(entry['mediaMetadata']['height'])
+        parsedImages.append(entry['id'], entry['productUrl'], entry['mimeType'], width, height)
       except:
         logging.exception('Failed due to:')
         logging.debug('Entry: %s', repr(entry))
@@ -19,6 +19,16 @@ import subprocess
 import os
 import logging
 import json
+import time
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+  import pyudev
+  USB_MONITOR = True
+except ImportError:
+  logging.info('pyudev module not available, storage devices will be polled')
+  USB_MONITOR = False
 
 from modules.helper import helper
 from modules.network import RequestResult
@@ -31,6 +41,92 @@ class USB_Photos(BaseService):
   SUBSTATE_NOT_CONNECTED = 404
 
   INDEX = 0
+  FIRST_IMAGE_TIMEOUT = 30 # seconds we wait for a new album to yield its first image
+  DEVICE_POLL = 30 # seconds between looking for storage devices while none is mounted
+
+  _POOL = None
+  _POOL_LOCK = threading.Lock()
+  _MONITOR = None
+
+  class DeviceMonitor:
+    # Listens to udev for block devices coming and going, so we only look
+    # for storage devices (udevadm, lsblk, mount) when something happened.
+    def __init__(self):
+      self.generation = 0
+      self.observer = None
+      if not USB_MONITOR:
+        return
+      try:
+        context = pyudev.Context()
+        monitor = pyudev.Monitor.from_netlink(context)
+        monitor.filter_by('block')
+        self.observer = pyudev.MonitorObserver(monitor, callback=self._event, name='USB-monitor')
+        self.observer.daemon = True
+        self.observer.start()
+      except:
+        logging.exception('Unable to monitor udev, storage devices will be polled')
+        self.observer = None
+
+    def isActive(self):
+      return self.observer is not None
+
+    def _event(self, device):
+      if device.action in ['add', 'remove', 'change']:
+        logging.debug('Storage device %s: %s', device.action, device.device_node)
+        self.generation += 1
+
+  class AlbumScan:
+    # Indexes one album in the background. Images can be used as soon as
+    # they're indexed, so a huge album doesn't hold up the slideshow.
+    def __init__(self, service, keyword, path, files, mtime):
+      self.service = service
+      self.keyword = keyword
+      self.path = path
+      self.files = files
+      self.images = []
+      self.lock = threading.Lock()
+      self.ready = threading.Event() # first image is available (or nothing was found)
+      self.done = threading.Event()
+      self.published = False
+      self.mtime = mtime
+
+    def start(self):
+      t = threading.Thread(target=self._scan, name='USB-scan-%s' % self.keyword)
+      t.daemon = True
+      t.start()
+      return self
+
+    def publish(self):
+      self.published = True
+      self._updateCount()
+
+    def getImages(self):
+      # Once done, the list doesn't change and can be handed out as-is
+      if self.done.is_set():
+        return self.images
+      with self.lock:
+        return list(self.images)
+
+    def _updateCount(self):
+      if self.published:
+        with self.lock:
+          self.service._STATE["_NUM_IMAGES"][self.keyword] = len(self.images)
+
+    def _scan(self):
+      try:
+        pool = USB_Photos._getPool()
+        for item in pool.imap(lambda f: self.service._indexFile(self.path, f), self.files, 4):
+          if item is None:
+            continue
+          with self.lock:
+            self.images.append(item)
+          self._updateCount()
+          self.ready.set()
+      except:
+        logging.exception('Unable to index "%s"', self.path)
+      logging.debug('Indexed %d images in "%s"', len(self.images), self.path)
+      self.done.set()
+      self.ready.set()
 
   class StorageUnit:
     def __init__(self):
@@ -81,8 +177,53 @@ class USB_Photos(BaseService):
       return self.label
 
   def __init__(self, configDir, id, name):
+    self._SCANS = {}
+    self._SCANS_LOCK = threading.Lock()
+    self._LISTING = None
+    self._DEVICE_GENERATION = None
+    self._DEVICE_DETECTED = 0
     BaseService.__init__(self, configDir, id, name, needConfig=False, needOAuth=False)
 
+  @staticmethod
+  def _getPool():
+    # Most of the work is done by identify, so use all cores
+    with USB_Photos._POOL_LOCK:
+      if USB_Photos._POOL is None:
+        try:
+          workers = multiprocessing.cpu_count()
+        except NotImplementedError:
+          workers = 1
+        USB_Photos._POOL = ThreadPool(max(1, workers))
+      return USB_Photos._POOL
+
+  @staticmethod
+  def _getMonitor():
+    with USB_Photos._POOL_LOCK:
+      if USB_Photos._MONITOR is None:
+        USB_Photos._MONITOR = USB_Photos.DeviceMonitor()
+      return USB_Photos._MONITOR
+
+  def _shouldDetect(self):
+    # True if storage devices may have changed since we last looked. Only
+    # used while nothing is mounted, so even with udev we look every now
+    # and then, in case mounting failed (device still settling, ...)
+    monitor = USB_Photos._getMonitor()
+    changed = False
+    if monitor.isActive():
+      generation = monitor.generation
+      changed = generation != self._DEVICE_GENERATION
+      self._DEVICE_GENERATION = generation
+    if changed or time.time() - self._DEVICE_DETECTED > USB_Photos.DEVICE_POLL:
+      self._DEVICE_DETECTED = time.time()
+      return True
+    return False
+
+  def _getMtime(self, path):
+    try:
+      return os.stat(path).st_mtime
+    except OSError:
+      return None
+
   def preSetup(self):
     USB_Photos.INDEX += 1
     self.usbDir = "/mnt/usb%d" % USB_Photos.INDEX
@@ -133,8 +274,9 @@ class USB_Photos(BaseService):
       keywords.append("_PHOTOFRAME_")
       # _PHOTOFRAME_ can be manually deleted via web interface if other keywords are specified!
 
-    self._STATE['_KEYWORDS'] = keywords
-    self.saveState()
+    if keywords != self._STATE['_KEYWORDS']:
+      self._STATE['_KEYWORDS'] = keywords
+      self.saveState()
     return keywords
 
   def checkForInvalidKeywords(self):
@@ -153,7 +295,7 @@ class USB_Photos(BaseService):
   def updateState(self):
     self.subState = None
     if not os.path.exists(self.baseDir):
-      if not self.mountStorageDevice():
+      if not self._shouldDetect() or not self.mountStorageDevice():
         self._CURRENT_STATE = BaseService.STATE_NO_IMAGES
         self.subState = USB_Photos.SUBSTATE_NOT_CONNECTED
         return self._CURRENT_STATE
@@ -251,6 +393,9 @@ class USB_Photos(BaseService):
         logging.info("USB-device '%s' successfully mounted to '%s'!" % (cmd[-2], cmd[-1]))
         if os.path.exists(self.baseDir):
           self.device = candidate
+          with self._SCANS_LOCK:
+            self._SCANS = {}
+          self._LISTING = None
           self.checkForInvalidKeywords()
           return True
       except subprocess.CalledProcessError:
@@ -270,10 +415,23 @@ class USB_Photos(BaseService):
 
   # All images directly inside '/photoframe' directory will be displayed without any keywords
   def getBaseDirImages(self):
-    return filter(lambda x: os.path.isfile(os.path.join(self.baseDir, x)), os.listdir(self.baseDir))
+    return self._getListing()[1]
 
   def getAllAlbumNames(self):
-    return filter(lambda x: os.path.isdir(os.path.join(self.baseDir, x)), os.listdir(self.baseDir))
+    return self._getListing()[0]
+
+  def _getListing(self):
+    # Returns (albums, images) of the basedir, only listed again when the
+    # directory has changed
+    mtime = self._getMtime(self.baseDir)
+    if mtime is None:
+      return ([], [])
+    if self._LISTING is None or self._LISTING[0] != mtime:
+      entries = os.listdir(self.baseDir)
+      albums = filter(lambda x: os.path.isdir(os.path.join(self.baseDir, x)), entries)
+      images = filter(lambda x: os.path.isfile(os.path.join(self.baseDir, x)), entries)
+      self._LISTING = (mtime, albums, images)
+    return self._LISTING[1:]
 
   def selectImageFromAlbum(self, destinationDir, supportedMimeTypes, displaySize, randomize):
     if self.device is None:
@@ -288,47 +446,96 @@ class USB_Photos(BaseService):
     else:
       return BaseService.createImageHolder(self).setError('No external storage device detected! Please connect a USB-stick!\n\n Place albums inside /photoframe/{album_name} directory and add each {album_name} as keyword.\n\nAlternatively, put images directly inside the "/photoframe/"-directory on your storage device.')
 
+  def _getAlbumPath(self, keyword):
+    if keyword == "_PHOTOFRAME_":
+      return self.baseDir
+    return os.path.join(self.baseDir, keyword)
+
+  def _startScan(self, keyword):
+    path = self._getAlbumPath(keyword)
+    # Before listing, so a change while we list causes another scan
+    mtime = self._getMtime(path)
+    if keyword == "_PHOTOFRAME_":
+      files = self.getBaseDirImages()
+    elif os.path.isdir(path):
+      files = os.listdir(path)
+    else:
+      logging.warning("The album '%s' does not exist. Did you unplug the storage device associated with '%s'?!" % (path, self.device))
+      return None
+    files = sorted(filter(lambda x: not x.startswith("."), files))
+    return USB_Photos.AlbumScan(self, keyword, path, files, mtime).start()
+
+  def _publishScan(self, keyword, scan):
+    with self._SCANS_LOCK:
+      self._SCANS[keyword] = scan
+    scan.publish()
+
   def getImagesFor(self, keyword):
     if not os.path.isdir(self.baseDir):
       return []
-    images = []
-    if keyword == "_PHOTOFRAME_":
-      files = filter(lambda x: not x.startswith("."), self.getBaseDirImages())
-      images = self.getAlbumInfo(self.baseDir, files)
-    else:
-      if os.path.isdir(os.path.join(self.baseDir, keyword)):
-        files = filter(lambda x: not x.startswith("."), os.listdir(os.path.join(self.baseDir, keyword)))
-        images = self.getAlbumInfo(os.path.join(self.baseDir, keyword), files)
+    with self._SCANS_LOCK:
+      scan = self._SCANS.get(keyword, None)
+    if scan is None:
+      scan = self._startScan(keyword)
+      if scan is None:
+        return []
+      self._publishScan(keyword, scan)
+    elif scan.done.is_set() and scan.mtime != self._getMtime(self._getAlbumPath(keyword)):
+      # Files were added or removed, index it again while we keep using the old one
+      logging.debug('Album "%s" has changed, rescanning', keyword)
+      if self._REFRESHER is not None:
+        self._REFRESHER.schedule(self, keyword)
       else:
-        logging.warning("The album '%s' does not exist. Did you unplug the storage device associated with '%s'?!" % (os.path.join(self.baseDir, keyword), self.device))
-    return images
-
-  def getAlbumInfo(self, path, files):
-    images = []
-    for filename in files:
-      fullFilename = os.path.join(path, filename)
-      dim = helper.getImageSize(fullFilename)
-      readable = True
-      if dim is None:
-        try:
-          with open(fullFilename, 'rb') as f:
-            f.read(1)
-          logging.warning('File %s has unknown format, skipping', fullFilename)
-          continue
-        except:
-          readable = False
-
-      if os.path.exists(fullFilename) and readable:
-        item = BaseService.createImageHolder(self)
-        item.setId(self.hashString(fullFilename))
-        item.setUrl(fullFilename).setSource(fullFilename)
-        item.setMimetype(helper.getMimetype(fullFilename))
-        item.setDimensions(dim['width'], dim['height'])
-        item.setFilename(filename)
-        images.append(item)
-      else:
-        logging.warning('File %s could not be read. Could be USB issue, try rebooting', fullFilename)
-    return images
+        return self.refreshImagesFor(keyword)
+    scan.ready.wait(USB_Photos.FIRST_IMAGE_TIMEOUT)
+    return scan.getImages()
+
+  def refreshImagesFor(self, keyword):
+    if not os.path.isdir(self.baseDir):
+      return []
+    with self._SCANS_LOCK:
+      old = self._SCANS.get(keyword, None)
+    if old is None or not old.done.is_set():
+      # Nothing to keep, so let the slideshow use images as they're indexed
+      return self.getImagesFor(keyword)
+    scan = self._startScan(keyword)
+    if scan is None:
+      return []
+    scan.done.wait()
+    self._publishScan(keyword, scan)
+    return scan.getImages()
+
+  def clearImagesFor(self, keyword):
+    with self._SCANS_LOCK:
+      self._SCANS.pop(keyword, None)
+
+  def _indexFile(self, path, filename):
+    # Runs in the thread pool, returns an image or None
+    fullFilename = os.path.join(path, filename)
+    dim = helper.getImageSize(fullFilename)
+    readable = True
+    if dim is None:
+      try:
+        with open(fullFilename, 'rb') as f:
+          f.read(1)
+        logging.warning('File %s has unknown format, skipping', fullFilename)
+        return None
+      except:
+        readable = False
+
+    if os.path.exists(fullFilename) and readable:
+      item = BaseService.createImageHolder(self)
+      item.setId(self.hashString(fullFilename))
+      item.setUrl(fullFilename).setSource(fullFilename)
+      item.setMimetype(helper.getMimetype(fullFilename))
+      item.setDimensions(dim['width'], dim['height'])
+      item.setFilename(filename)
+      if self._DEDUPEMGR is not None:
+        # Might as well, we're already reading the file
+        self._DEDUPEMGR.add(item.getCacheId(), fullFilename)
+      return item
+    logging.warning('File %s could not be read. Could be USB issue, try rebooting', fullFilename)
+    return None
 
   def requestUrl(self, url, destination=None, params=None, data=None, usePost=False):
     # pretend to download the file (for compatability with 'selectImageFromAlbum' of baseService)
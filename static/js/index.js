@@ -40,6 +40,22 @@ Validator = function() {
 		return i.toString();
 	}
 
+	this.transitionTime = function(input) {
+		f = parseFloat(input);
+		if (f < 0 || isNaN(f))
+			f = 0;
+		if (f > 10)
+			f = 10;
+		return f.toString();
+	}
+
+	this.historySize = function(input) {
+		i = parseInt(input);
+		if (i < 0 || isNaN(i))
+			i = 0;
+		return i.toString();
+	}
+
 	this.refresh = function(input) {
 		i = parseInt(input);
 		if (i < 0 || isNaN(i))
@@ -52,11 +52,61 @@ function rebootWatchCheck() {
   });
 }
 
-// Refresh image every 30s
+// Changes are pushed to us if the browser supports it, otherwise we poll
+var eventStream = null;
+if (window.EventSource) {
+  eventStream = new EventSource('/events/stream');
+  eventStream.addEventListener('slide', function(e) {
+    clearTimeout(reloadScreenTimeout);
+    reloadScreen();
+  });
+  eventStream.addEventListener('color', function(e) {
+    showAmbient(JSON.parse(e.data)['data']);
+  });
+  eventStream.addEventListener('service', function(e) {
+    // Page shows different controls depending on state, reload unless user is typing
+    var data = JSON.parse(e.data)['data'];
+    var entry = $('[data-service-state="' + data['id'] + '"]');
+    if (entry.length == 0 || entry.attr('data-state') == data['state'])
+      return;
+    entry.attr('data-state', data['state']);
+    if ($('.keyword').filter(function() { return this.value != ''; }).length == 0)
+      location.reload();
+  });
+  eventStream.onerror = function(e) {
+    if (eventStream.readyState == EventSource.CLOSED) {
+      // Server refused (too many streams), go back to polling
+      eventStream = null;
+      reloadScreen();
+      updateAmbient();
+    }
+  };
+}
+
+// Refresh image every 30s. The URL stays the same so the browser can ask
+// with If-None-Match and only gets a new image when the screen changed
+var screenTag = null;
+var screenUrl = null;
 function reloadScreen() {
-  $('#screen').attr('src', "/details/current?" + new Date().getTime())
-  reloadScreenTimeout = setTimeout(reloadScreen, 30000);
+  var url = "/details/current";
+  var width = Math.round($('#screen').width() * (window.devicePixelRatio || 1));
+  if (width > 0)
+    url += "?width=" + width;
+  fetch(url, { cache: 'no-cache', credentials: 'same-origin' }).then(function(response) {
+    if (!response.ok || response.headers.get('ETag') == screenTag)
+      return;
+    screenTag = response.headers.get('ETag');
+    return response.blob().then(function(blob) {
+      if (screenUrl != null)
+        URL.revokeObjectURL(screenUrl);
+      screenUrl = URL.createObjectURL(blob);
+      $('#screen').attr('src', screenUrl);
+    });
+  });
+  if (eventStream == null)
+    reloadScreenTimeout = setTimeout(reloadScreen, 30000);
 }
+var reloadScreenTimeout = null;
 reloadScreen();
 
 $(".slideshowControl").click(function () {
@@ -69,6 +119,11 @@ $(".slideshowControl").click(function () {
   });
 });
 
+function showAmbient(data) {
+  $('#colortemp').text(data['temperature'].toFixed(0));
+  $('#lux').text(data['lux'].toFixed(2));
+}
+
 function updateAmbient() {
   $.ajax({
     url:'/details/color'
@@ -76,9 +131,9 @@ function updateAmbient() {
     if (data['temperature'] == null)
     return;
 
-    $('#colortemp').text(data['temperature'].toFixed(0));
-    $('#lux').text(data['lux'].toFixed(2));
-    setTimeout(updateAmbient, 5000);
+    showAmbient(data);
+    if (eventStream == null)
+      setTimeout(updateAmbient, 5000);
   });
 }
 updateAmbient();
@@ -215,6 +270,14 @@ $("select[name=enable-cache]").change(function () {
   });
 });
 
+$("select[name=transition]").change(function () {
+  $.ajax({
+    url: "/setting/" + $(this).attr('name') + "/" + encodeURIComponent($(this).val()),
+    type: "PUT"
+  }).done(function () {
+  });
+});
+
 $("select[name=offline-behavior]").change(function () {
   $.ajax({
     url: "/setting/" + $(this).attr('name') + "/" + encodeURIComponent($(this).val()),
@@ -380,6 +443,23 @@ $('.keyword').keypress(function (e) {
   }
 });
 
+var suggestTimer = null;
+$('.keyword[list]').on('input', function() {
+  var input = $(this);
+  clearTimeout(suggestTimer);
+  suggestTimer = setTimeout(function() {
+    $.ajax({
+      url:"/keywords/" + input.data('service') + "/suggest",
+      type:"GET",
+      data: { q: input.val() }
+    }).done(function(data){
+      var list = $('#' + input.attr('list')).empty();
+      for (var i = 0; i < data['suggestions'].length; i++)
+        list.append($('<option>').attr('value', data['suggestions'][i]));
+    });
+  }, 250);
+});
+
 $('.keyword-add').click(function(){
   $('#busy').show();
   $.ajax({